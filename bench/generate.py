@@ -0,0 +1,188 @@
+"""
+Generates synthetic courses for benchmarking: a tree of manifests, Markdown and Typst sources and
+attachments on disk, and the matching course contents for the fake Moodle server.
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+import json
+import random
+
+
+MODS = ['page', 'label', 'assign', 'folder', 'resource']
+
+
+@dataclass
+class Course:
+    # the top-level manifest listing all modules
+    manifest: Path
+    # course ID -> sections as returned by core_course_get_contents
+    contents: dict[int, list[dict]]
+    modules: int
+
+
+def _markdown(i: int, attachments: list[str]) -> str:
+    images = ''.join(f'![Image {j}](@@PLUGINFILE@@/{name})\n\n' for j, name in enumerate(attachments))
+    return f"""# Module {i}
+
+Lorem ipsum dolor sit amet, *consectetur* adipiscing elit. Sed do eiusmod tempor incididunt ut labore
+et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud **exercitation** ullamco laboris.
+
+- first item
+- second item with `code`
+
+{images}```python
+def f(x):
+    return x * {i}
+```
+"""
+
+
+def _typst(i: int, frontmatter: str, attachments: list[str]) -> str:
+    metadata = ''.join(f'#metadata("{name}")<attachments>\n' for name in attachments)
+    return f"""#metadata({frontmatter})<frontmatter>
+{metadata}
+= Module {i}
+
+Lorem ipsum dolor sit amet, _consectetur_ adipiscing elit. Sed do eiusmod tempor incididunt ut labore
+et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud *exercitation* ullamco laboris.
+
+- first item
+- second item with `code`
+
+#for j in range(20) [
+  == Section #j
+  #lorem(40)
+
+  ```python
+  def f(x):
+      return x * {i} + {{j}}
+  ```
+]
+"""
+
+
+def _typst_dict(d: dict) -> str:
+    def value(v):
+        if isinstance(v, dict):
+            return _typst_dict(v)
+        if isinstance(v, list):
+            return '(' + ''.join(f'{value(x)}, ' for x in v) + ')'
+        if isinstance(v, str):
+            return f'"{v}"'
+        return str(v)
+    return '(' + ', '.join(f'"{k}": {value(v)}' for k, v in d.items()) + ')'
+
+
+def generate_course(
+    directory: Path,
+    *,
+    modules: int = 100,
+    attachments: int = 2,
+    typst: float = 0.5,
+    attachment_size: int = 64 * 1024,
+    course: int = 2,
+    seed: int = 0,
+) -> Course:
+    """
+    Writes `modules` modules into `directory`. Each module with rich text content gets `attachments`
+    attachments, half of which are shared between all modules. A `typst` share of modules uses Typst
+    instead of Markdown sources.
+    """
+    rng = random.Random(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory/'modules').mkdir(exist_ok=True)
+    (directory/'files').mkdir(exist_ok=True)
+
+    def write_file(name: str) -> str:
+        path = directory/'files'/name
+        if not path.exists():
+            path.write_bytes(rng.randbytes(attachment_size))
+        return f'../files/{name}'
+
+    shared = [write_file(f'shared-{j}.jpg') for j in range(attachments // 2)]
+
+    sections = [dict(id=100 + s, name=f'Section {s}', summary='', summaryformat=1, section=s, visible=1, modules=[]) for s in range(10)]
+    children = []
+    for i in range(modules):
+        cmid = 1000 + i
+        mod = MODS[i % len(MODS)]
+        section = sections[i % len(sections)]
+        own = [write_file(f'module-{i}-{j}.jpg') for j in range(attachments - len(shared))]
+        files = shared + own
+        use_typst = rng.random() < typst
+
+        source = f'module-{i}.typ' if use_typst else f'module-{i}.md'
+        editor = dict(source=source) if use_typst else dict(source=source, attachments=files)
+        meta = dict(mod=mod, course=course, cmid=cmid)
+        match mod:
+            case 'page':
+                meta['page'] = editor
+            case 'label':
+                meta['intro'] = editor
+            case 'assign':
+                meta['intro'] = editor
+                meta['attachments'] = files
+            case 'folder':
+                # destination names without the relative path
+                meta['files'] = {Path(f).name: f for f in files}
+            case 'resource':
+                meta['file'] = files[0] if files else write_file(f'module-{i}.pdf')
+
+        path = directory/'modules'/source
+        if use_typst:
+            path.write_text(_typst(i, _typst_dict(meta), files))
+        else:
+            # JSON is valid YAML, and avoids depending on a YAML writer
+            path.write_text(f"---\n{json.dumps(meta)}\n---\n{_markdown(i, [Path(f).name for f in files])}")
+        children.append(f'modules/{source}')
+
+        contents = []
+        if mod == 'folder':
+            contents = [Path(f).name for f in files]
+        elif mod == 'resource':
+            contents = [Path(meta['file']).name]
+        contents = [dict(type='file', filename=name, filepath='/', filesize=attachment_size) for name in contents]
+        section['modules'].append(dict(
+            id=cmid, name=f'Module {i}', modicon='', modname=mod, modplural=f'{mod}s', indent=0,
+            visible=1, contents=contents,
+        ))
+
+    manifest = directory/'list.yaml'
+    manifest.write_text('children:\n' + ''.join(f'- {child}\n' for child in children))
+    return Course(manifest=manifest, contents={course: sections}, modules=modules)
+
+
+def generate_folder(
+    directory: Path,
+    *,
+    subdirectories: int = 80,
+    files: int = 2,
+    file_size: int = 16 * 1024,
+    course: int = 2,
+    cmid: int = 900,
+    seed: int = 0,
+) -> Course:
+    """
+    Writes a single folder module whose files are spread over `subdirectories` directories, some of
+    them nested, with `files` files each.
+    """
+    rng = random.Random(seed)
+    (directory/'folder').mkdir(parents=True, exist_ok=True)
+
+    entries = {}
+    for i in range(subdirectories):
+        # every fourth directory is nested in the previous one
+        parent = f'exam-{i - 1}/' if i % 4 == 3 else ''
+        for j in range(files):
+            path = directory/'folder'/f'file-{i}-{j}.pdf'
+            path.write_bytes(rng.randbytes(file_size))
+            entries[f'{parent}exam-{i}/file-{j}.pdf'] = f'folder/{path.name}'
+
+    manifest = directory/'folder.yaml'
+    manifest.write_text(json.dumps(dict(mod='folder', course=course, cmid=cmid, files=entries)))
+    section = dict(id=100, name='Section 0', summary='', summaryformat=1, section=0, visible=1, modules=[dict(
+        id=cmid, name='Exam material', modicon='', modname='folder', modplural='folders', indent=0,
+        visible=1, contents=[],
+    )])
+    return Course(manifest=manifest, contents={course: [section]}, modules=1)
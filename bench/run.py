@@ -0,0 +1,209 @@
+"""
+Benchmarks for `mdl`, run against a synthetic course and a local fake Moodle server (see
+`generate.py` and `server.py`), so that no real Moodle installation is needed:
+
+    python bench/run.py --modules 200 --latency 0.02 --json results.json
+
+With `--baseline`, the results are compared against an earlier `--json` output, and the script
+fails if a benchmark got slower by more than `--tolerance`; this can be used to guard against
+performance regressions in CI.
+"""
+
+from pathlib import Path
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate import generate_course, generate_folder
+from server import FakeMoodle
+
+
+def reset_caches():
+    # in-process benchmarks should not profit from the previous repetition
+    import mdl.payload
+    import mdl.sources
+    import mdl.typst
+    mdl.typst._documents.clear()
+    mdl.sources._sources.clear()
+    mdl.payload._file_hashes.clear()
+
+
+def run_mdl(args: list[str], *, cwd: Path, env: dict = None):
+    result = subprocess.run(
+        [sys.executable, '-m', 'mdl.cli', *args],
+        cwd=cwd,
+        env={**os.environ, **(env or {})},
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"mdl {' '.join(args)} failed:\n{result.stderr}")
+    return result
+
+
+# dependencies that must only be imported by the commands that need them
+HEAVY_MODULES = ['moodle', 'requests', 'typst', 'bs4', 'ruamel.yaml', 'multiprocessing']
+
+
+def bench_startup(ctx):
+    start = time.perf_counter()
+    run_mdl(['--help'], cwd=ctx.directory)
+    elapsed = time.perf_counter() - start
+
+    result = subprocess.run(
+        [sys.executable, '-c', f'import sys, mdl.cli; print(*(m for m in {HEAVY_MODULES!r} if m in sys.modules))'],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    if result.stdout.strip():
+        raise RuntimeError(f"importing mdl.cli also imports {result.stdout.strip()}")
+    return elapsed
+
+
+def bench_collect_metas(ctx):
+    from mdl import course
+
+    reset_caches()
+    start = time.perf_counter()
+    course.collect_metas([ctx.course.manifest])
+    return time.perf_counter() - start
+
+
+def bench_dependencies(ctx):
+    from mdl import course
+
+    metas = course.collect_metas([ctx.course.manifest])
+    reset_caches()
+    start = time.perf_counter()
+    for _, root, module in metas:
+        module.dependencies(root)
+    return time.perf_counter() - start
+
+
+def bench_render(ctx):
+    from mdl import course
+    from mdl.payload import prepare_module
+
+    metas = course.collect_metas([ctx.course.manifest])
+    reset_caches()
+    start = time.perf_counter()
+    for _, root, module in metas:
+        prepare_module(root, module)
+    return time.perf_counter() - start
+
+
+def bench_upload(ctx):
+    with FakeMoodle(ctx.course.contents, latency=ctx.args.latency) as server:
+        start = time.perf_counter()
+        run_mdl(
+            [
+                'upload', '--force', '--state', str(ctx.directory/'state.json'),
+                '--jobs', str(ctx.args.jobs), '--render-jobs', str(ctx.args.render_jobs),
+                '--batch-size', str(ctx.args.batch_size),
+                str(ctx.course.manifest),
+            ],
+            cwd=ctx.directory,
+            env=dict(MOODLE_BASE_URL=server.base_url, MOODLE_TOKEN='0' * 32),
+        )
+        elapsed = time.perf_counter() - start
+
+    updates = sum(count for key, count in server.stats.items() if key.startswith('local_modcontentservice_'))
+    if updates != ctx.course.modules:
+        raise RuntimeError(f"expected {ctx.course.modules} module updates, but the server received {updates}")
+    ctx.notes['upload'] = f"{ctx.course.modules / elapsed:.1f} modules/s, {server.stats['requests']} requests"
+    return elapsed
+
+
+def bench_folder(ctx):
+    with FakeMoodle(ctx.folder.contents, latency=ctx.args.latency) as server:
+        start = time.perf_counter()
+        run_mdl(
+            ['upload', '--force', '--state', str(ctx.directory/'state.json'), str(ctx.folder.manifest)],
+            cwd=ctx.directory,
+            env=dict(MOODLE_BASE_URL=server.base_url, MOODLE_TOKEN='0' * 32),
+        )
+        elapsed = time.perf_counter() - start
+
+    expected = ctx.args.subdirectories * ctx.args.folder_files
+    if server.stats['draft files'] != expected:
+        raise RuntimeError(f"expected {expected} uploaded files, but the server received {server.stats['draft files']}")
+    ctx.notes['folder'] = f"{expected / elapsed:.1f} files/s, {server.stats['requests']} requests"
+    return elapsed
+
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'collect_metas': bench_collect_metas,
+    'dependencies': bench_dependencies,
+    'render': bench_render,
+    'upload': bench_upload,
+    'folder': bench_folder,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark mdl against a fake Moodle server")
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help=f"the benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument('--modules', type=int, default=100)
+    parser.add_argument('--attachments', type=int, default=2)
+    parser.add_argument('--typst', type=float, default=0.5, help="the share of modules using Typst sources")
+    parser.add_argument('--latency', type=float, default=0.01, help="seconds of latency per request")
+    parser.add_argument('--jobs', type=int, default=8, help="`--jobs` for `mdl upload`")
+    parser.add_argument('--render-jobs', type=int, default=os.cpu_count(), help="`--render-jobs` for `mdl upload`")
+    parser.add_argument('--batch-size', type=int, default=50, help="`--batch-size` for `mdl upload`")
+    parser.add_argument('--subdirectories', type=int, default=80, help="the number of directories of the `folder` benchmark")
+    parser.add_argument('--folder-files', type=int, default=2, help="the number of files per directory of the `folder` benchmark")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', type=Path, help="a file to write the results to")
+    parser.add_argument('--baseline', type=Path, help="results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="the allowed slowdown relative to the baseline")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    class Context:
+        pass
+
+    with tempfile.TemporaryDirectory(prefix='mdl-bench-') as directory:
+        ctx = Context()
+        ctx.args = args
+        ctx.directory = Path(directory)
+        ctx.course = generate_course(ctx.directory, modules=args.modules, attachments=args.attachments, typst=args.typst)
+        ctx.folder = generate_folder(ctx.directory, subdirectories=args.subdirectories, files=args.folder_files)
+        ctx.notes = {}
+
+        results = {}
+        print(f"{'benchmark':<16} {'min s':>9} {'median s':>9}")
+        for name in args.benchmarks or BENCHMARKS:
+            times = [BENCHMARKS[name](ctx) for _ in range(args.repeat)]
+            results[name] = dict(min=min(times), median=statistics.median(times))
+            note = ctx.notes.get(name, '')
+            print(f"{name:<16} {results[name]['min']:>9.3f} {results[name]['median']:>9.3f}  {note}")
+
+    if args.json is not None:
+        with open(args.json, 'wt') as f:
+            json.dump(dict(parameters={k: v for k, v in vars(args).items() if k not in ('json', 'baseline')}, results=results), f, indent=2, default=str)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'rt') as f:
+            baseline = json.load(f)['results']
+        regressions = [
+            f"{name}: {result['median']:.3f}s, baseline {baseline[name]['median']:.3f}s"
+            for name, result in results.items()
+            if name in baseline and result['median'] > baseline[name]['median'] * (1 + args.tolerance)
+        ]
+        if regressions:
+            print("slower than the baseline:", *regressions, sep='\n  ', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
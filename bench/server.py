@@ -0,0 +1,333 @@
+"""
+A local stand-in for the parts of the Moodle webservice API that `mdl` uses. It keeps a course
+structure in memory, accepts draft uploads and content updates, and counts requests and bytes.
+Every request can be delayed by a fixed latency to simulate a remote server.
+
+Run it directly to serve a course generated by `generate.py`:
+
+    python bench/server.py --modules 300 --latency 0.05
+"""
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+import itertools
+import json
+import threading
+import time
+
+
+FUNCTIONS = [
+    'core_webservice_get_site_info',
+    'core_course_get_contents',
+    'core_course_get_course_module',
+    'core_files_get_unused_draft_itemid',
+    'local_modcontentservice_update_assign_content',
+    'local_modcontentservice_update_folder_content',
+    'local_modcontentservice_update_label_content',
+    'local_modcontentservice_update_page_content',
+    'local_modcontentservice_update_resource_content',
+    'local_modcontentservice_update_section_content',
+    'mod_assign_get_assignments',
+    'mod_folder_get_folders_by_courses',
+    'mod_label_get_labels_by_courses',
+    'mod_page_get_pages_by_courses',
+    'mod_resource_get_resources_by_courses',
+    'tool_mobile_call_external_functions',
+]
+
+# module type -> the function listing modules by course, and the key of the list in its response
+LIST_FUNCTIONS = {
+    'folder': ('mod_folder_get_folders_by_courses', 'folders'),
+    'label': ('mod_label_get_labels_by_courses', 'labels'),
+    'page': ('mod_page_get_pages_by_courses', 'pages'),
+    'resource': ('mod_resource_get_resources_by_courses', 'resources'),
+}
+
+
+def _nested(args: dict) -> dict:
+    # turns form fields such as `intro[text]` into nested dicts
+    result = {}
+    for key, value in args.items():
+        parts = key.replace(']', '').split('[')
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return result
+
+
+def _file_list(files: dict[str, int]) -> list[dict]:
+    return [
+        dict(type='file', filename=path.rsplit('/', 1)[1], filepath=path.rsplit('/', 1)[0] + '/', filesize=size)
+        for path, size in sorted(files.items())
+    ]
+
+
+class FakeMoodle(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, courses: dict[int, list[dict]], *, latency: float = 0.0, port: int = 0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        # course ID -> list of sections as returned by core_course_get_contents
+        self.courses = courses
+        self.latency = latency
+        self.functions = list(FUNCTIONS)
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self._itemids = itertools.count(1000)
+        # itemid -> {file path: size} of uploaded draft areas
+        self.drafts = {}
+        # cmid -> {editor or file area: content} of updated modules
+        self.content = {}
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, key: str, amount: int = 1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def new_itemid(self) -> int:
+        with self.lock:
+            return next(self._itemids)
+
+    def find_module(self, cmid: int):
+        for courseid, sections in self.courses.items():
+            for section in sections:
+                for cm in section['modules']:
+                    if cm['id'] == cmid:
+                        return courseid, section, cm
+        return None
+
+    def call(self, wsfunction: str, args: dict):
+        if wsfunction not in self.functions:
+            return dict(exception='webservice_access_exception', errorcode='accessexception', message=f"Access control exception: {wsfunction}")
+
+        match wsfunction:
+            case 'core_webservice_get_site_info':
+                return dict(
+                    sitename='Fake Moodle',
+                    functions=[dict(name=name, version='1') for name in self.functions],
+                )
+            case 'core_course_get_contents':
+                return self.courses.get(int(args['courseid']), [])
+            case 'core_files_get_unused_draft_itemid':
+                return dict(component='user', contextid=1, itemid=self.new_itemid(), warnings=[])
+            case 'core_course_get_course_module':
+                found = self.find_module(int(args['cmid']))
+                if found is None:
+                    return dict(exception='dml_missing_record_exception', errorcode='invalidrecord', message="Can't find data record in database.")
+                courseid, section, cm = found
+                return dict(cm=dict(
+                    id=cm['id'], course=courseid, module=1, name=cm['name'], modname=cm['modname'],
+                    instance=cm['id'], section=section['id'], sectionnum=section['section'],
+                    groupmode=0, groupingid=0, completion=0, visible=1,
+                ), warnings=[])
+            case 'tool_mobile_call_external_functions':
+                responses = []
+                for i in itertools.count():
+                    if f'requests[{i}][function]' not in args:
+                        break
+                    function = args[f'requests[{i}][function]']
+                    self.count(function)
+                    result = self.call(function, json.loads(args[f'requests[{i}][arguments]']))
+                    if isinstance(result, dict) and 'exception' in result:
+                        # like Moodle, stop at the first failing call
+                        responses.append(dict(error=True, exception=json.dumps(result)))
+                        break
+                    responses.append(dict(error=False, data=json.dumps(result)))
+                return dict(responses=responses)
+            case 'mod_assign_get_assignments':
+                return dict(courses=[
+                    dict(id=courseid, assignments=[
+                        dict(
+                            cmid=cm['id'],
+                            **self.editor(cm['id'], 'intro', 'intro', 'introfiles'),
+                            **self.editor(cm['id'], 'activity', 'activity', 'activityattachments'),
+                            introattachments=_file_list(self.content.get(cm['id'], {}).get('attachments', {})),
+                        )
+                        for cm in self.modules(courseid, 'assign')
+                    ])
+                    for courseid in self.courseids(args)
+                ], warnings=[])
+            case _ if wsfunction in (function for function, _ in LIST_FUNCTIONS.values()):
+                mod, (_, key) = next((mod, entry) for mod, entry in LIST_FUNCTIONS.items() if entry[0] == wsfunction)
+                modules = []
+                for courseid in self.courseids(args):
+                    for cm in self.modules(courseid, mod):
+                        module = dict(coursemodule=cm['id'], course=courseid, **self.editor(cm['id'], 'intro', 'intro', 'introfiles'))
+                        if mod == 'page':
+                            module.update(self.editor(cm['id'], 'page', 'content', 'contentfiles'))
+                        elif mod == 'resource':
+                            module['contentfiles'] = _file_list(self.content.get(cm['id'], {}).get('files', {}))
+                        modules.append(module)
+                return {key: modules, 'warnings': []}
+            case _ if wsfunction.startswith('local_modcontentservice_update_'):
+                return self.update(wsfunction.removeprefix('local_modcontentservice_update_').removesuffix('_content'), _nested(args))
+            case _:
+                return dict(exception='coding_exception', errorcode='codingerror', message=f"{wsfunction} is not implemented")
+
+
+    def courseids(self, args: dict) -> list[int]:
+        args = _nested(args)
+        courseids = args.get('courseids', {})
+        return [int(courseid) for courseid in (courseids.values() if isinstance(courseids, dict) else courseids)]
+
+    def modules(self, courseid: int, mod: str) -> list[dict]:
+        return [cm for section in self.courses.get(courseid, []) for cm in section['modules'] if cm['modname'] == mod]
+
+    def editor(self, cmid: int, name: str, field: str, files: str) -> dict:
+        text, format, draft = self.content.get(cmid, {}).get(name, ('', 1, {}))
+        return {field: text, f'{field}format': format, files: _file_list(draft)}
+
+    def update(self, mod: str, args: dict):
+        def draft(itemid) -> dict[str, int]:
+            return dict(self.drafts.get(int(itemid or 0), {}))
+
+        def editor(value) -> tuple:
+            value = value or {}
+            return value.get('text', ''), int(value.get('format', 1)), draft(value.get('itemid'))
+
+        if mod == 'section':
+            for sections in self.courses.values():
+                for section in sections:
+                    if section['id'] == int(args['section']):
+                        section['summary'], section['summaryformat'], _ = editor(args.get('summary'))
+                        return 'ok'
+            return dict(exception='dml_missing_record_exception', errorcode='invalidrecord', message="Can't find data record in database.")
+
+        found = self.find_module(int(args['cmid']))
+        if found is None or found[2]['modname'] != mod:
+            return dict(exception='dml_missing_record_exception', errorcode='invalidrecord', message="Can't find data record in database.")
+        _, _, cm = found
+
+        content = dict(intro=editor(args.get('intro')))
+        for name in ('activity', 'page'):
+            if name in args:
+                content[name] = editor(args[name])
+        for name in ('attachments', 'files'):
+            if name in args:
+                content[name] = draft(args[name])
+        with self.lock:
+            self.content[cm['id']] = content
+            if 'files' in content:
+                cm['contents'] = _file_list(content['files'])
+        return 'ok'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server: FakeMoodle = self.server
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length', 0))
+
+        if server.latency:
+            time.sleep(server.latency)
+        server.count('requests')
+        server.count('bytes received', length)
+
+        if url.path == '/webservice/upload.php':
+            # stream the body away, keeping only the names and sizes of the files
+            boundary = b'--' + self.headers.get_param('boundary').encode()
+            files = {}
+            remaining = length
+            buffer = b''
+            current = None
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 64 * 1024))
+                remaining -= len(chunk)
+                buffer += chunk
+                while True:
+                    index = buffer.find(boundary)
+                    if index == -1:
+                        # keep enough bytes to recognize a boundary that is split between chunks
+                        keep = len(boundary) + 2
+                        if len(buffer) > keep:
+                            if current is not None:
+                                files[current] += len(buffer) - keep
+                            buffer = buffer[-keep:]
+                        break
+                    if current is not None:
+                        # the part ends with CRLF before the boundary
+                        files[current] += index - 2
+                        current = None
+                    buffer = buffer[index:]
+                    header_end = buffer.find(b'\r\n\r\n')
+                    if header_end == -1:
+                        # the rest of the header is still to come, or this is the closing boundary
+                        break
+                    current = buffer[:header_end].decode().partition('filename="')[2].partition('"')[0] or None
+                    if current is not None:
+                        files[current] = 0
+                    buffer = buffer[header_end + 4:]
+            server.count('draft uploads')
+            server.count('draft files', len(files))
+
+            itemid = int(params.get('itemid', 0)) or server.new_itemid()
+            filepath = params.get('filepath', '/')
+            with server.lock:
+                draft = server.drafts.setdefault(itemid, {})
+                for name, size in files.items():
+                    draft[f'{filepath}{name}'] = size
+            self.reply([dict(itemid=itemid, filepath=filepath)])
+        elif url.path == '/webservice/rest/server.php':
+            args = dict(parse_qsl(self.rfile.read(length).decode()))
+            wsfunction = params.get('wsfunction', '')
+            server.count(wsfunction)
+            self.reply(server.call(wsfunction, args))
+        else:
+            self.send_error(404)
+
+
+if __name__ == '__main__':
+    import argparse
+    from pathlib import Path
+    import tempfile
+
+    from generate import generate_course
+
+    parser = argparse.ArgumentParser(description="serve a synthetic course through a fake Moodle webservice")
+    parser.add_argument('--modules', type=int, default=100)
+    parser.add_argument('--attachments', type=int, default=2)
+    parser.add_argument('--typst', type=float, default=0.5, help="the share of modules using Typst sources")
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--directory', type=Path, help="where to generate the course; defaults to a temporary directory")
+    args = parser.parse_args()
+
+    directory = args.directory or Path(tempfile.mkdtemp(prefix='mdl-bench-'))
+    course = generate_course(directory, modules=args.modules, attachments=args.attachments, typst=args.typst)
+    with FakeMoodle(course.contents, latency=args.latency, port=args.port) as server:
+        print(f"serving {args.modules} modules at {server.base_url}")
+        print(f"manifest: {course.manifest}")
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+        print(dict(server.stats))
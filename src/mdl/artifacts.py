@@ -0,0 +1,133 @@
+from importlib import metadata
+from pathlib import Path, PurePosixPath
+import hashlib
+import json
+import os
+import shutil
+
+from .course import ModuleMeta, SectionMeta
+from .files import write_atomic
+from .payload import EditorPayload, ModulePayload, UploadFile, file_hash
+
+
+# changes whenever the artifact format or the way payloads are rendered changes incompatibly
+FORMAT = 1
+
+
+def _version(package: str):
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+class ArtifactStore:
+    """
+    Stores rendered module payloads, so that they can be uploaded later (e.g. on another machine)
+    without rendering them again. A payload is stored under a key derived from everything it is
+    rendered from, and the files it uploads are stored under the hash of their content; a store can
+    therefore be cached and reused between builds, and unchanged modules are not rendered again.
+
+    The layout is:
+
+    - `payloads/<key[:2]>/<key>.json`: a payload, referring to files by their hash
+    - `files/<hash[:2]>/<hash>`: the content of a file
+    - `build.json`: the modules of the last build, in the order of the manifests
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def key(self, root: Path, module: ModuleMeta | SectionMeta, dependencies: list[Path], options) -> str:
+        # paths are relative to the working directory, so that keys don't depend on where the
+        # sources are checked out
+        data = dict(
+            format=FORMAT,
+            versions=dict(mdl=_version('mdl'), typst=_version('typst')),
+            root=os.path.relpath(root),
+            module=repr(module),
+            files=[(os.path.relpath(dep), file_hash(dep)) for dep in dependencies],
+            options=repr(options),
+        )
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def _payload_path(self, key: str) -> Path:
+        return self.path/'payloads'/key[:2]/f'{key}.json'
+
+    def _file_path(self, hash: str) -> Path:
+        return self.path/'files'/hash[:2]/hash
+
+    def has(self, key: str) -> bool:
+        return self._payload_path(key).exists()
+
+    def _write(self, path: Path, write):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(path, write)
+
+    def _store_files(self, files: list[UploadFile]) -> list[tuple[str, str]]:
+        result = []
+        for dest, f in files:
+            hash = file_hash(f)
+            path = self._file_path(hash)
+            if not path.exists():
+                self._write(path, lambda tmp: shutil.copyfile(f, tmp))
+            result.append((str(dest), hash))
+        return result
+
+    def _load_files(self, files: list[tuple[str, str]]) -> list[UploadFile]:
+        return [(PurePosixPath(dest), self._file_path(hash)) for dest, hash in files]
+
+    def write(self, key: str, payload: ModulePayload):
+        data = dict(
+            function=payload.function,
+            target=payload.target,
+            course=payload.course,
+            editors={
+                name: None if editor is None else dict(
+                    text=editor.text,
+                    format=editor.format,
+                    files=self._store_files(editor.files),
+                )
+                for name, editor in payload.editors.items()
+            },
+            files={
+                name: self._store_files(files)
+                for name, files in payload.files.items()
+            },
+        )
+        self._write(self._payload_path(key), lambda tmp: tmp.write_text(json.dumps(data)))
+
+    def read(self, key: str) -> ModulePayload:
+        with open(self._payload_path(key), 'rt') as f:
+            data = json.load(f)
+        return ModulePayload(
+            function=data['function'],
+            target=data['target'],
+            course=data['course'],
+            editors={
+                name: None if editor is None else EditorPayload(
+                    text=editor['text'],
+                    format=editor['format'],
+                    files=self._load_files(editor['files']),
+                )
+                for name, editor in data['editors'].items()
+            },
+            files={
+                name: self._load_files(files)
+                for name, files in data['files'].items()
+            },
+        )
+
+    def write_build(self, modules: list[tuple[str, str]]):
+        """
+        Records the modules of a build as `(name, key)` pairs.
+        """
+        data = dict(format=FORMAT, modules=[dict(name=name, key=key) for name, key in modules])
+        self._write(self.path/'build.json', lambda tmp: tmp.write_text(json.dumps(data, indent=2)))
+
+    def read_build(self) -> list[tuple[str, str]]:
+        with open(self.path/'build.json', 'rt') as f:
+            data = json.load(f)
+        if data.get('format') != FORMAT:
+            raise ValueError(f"{self.path} was built by an incompatible version of mdl")
+        return [(module['name'], module['key']) for module in data['modules']]
@@ -0,0 +1,102 @@
+from pathlib import Path
+import hashlib
+import json
+import threading
+import time
+
+from .files import write_atomic
+
+
+class ReadCache:
+    """
+    Caches the responses of webservice functions that only read course structure, so that repeated
+    lookups (e.g. verifying modules, or listing a course's contents) don't need to contact Moodle.
+    Entries expire after `ttl` seconds; with `refresh`, cached entries are not used but replaced.
+    Responses are stored per Moodle site and token (see `site`), since different users may see
+    different courses; clients of different sites share one cache per file.
+    """
+
+    FUNCTIONS = {
+        'core_webservice_get_site_info',
+        'core_course_search_courses',
+        'core_course_get_contents',
+        'core_course_get_course_module',
+    }
+
+    def __init__(self, path: Path, *, ttl: float = 3600, refresh: bool = False):
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.dirty = False
+        try:
+            with open(path, 'rt') as f:
+                self.data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.data = {}
+
+    @staticmethod
+    def site(url: str, token: str) -> str:
+        # the token is part of the key because different users can see different courses
+        token_hash = hashlib.sha256(token.encode()).hexdigest()[:16]
+        return f'{url}#{token_hash}'
+
+    def entries(self, site: str) -> dict[str, dict]:
+        return self.data.setdefault(site, {})
+
+    @staticmethod
+    def key(wsfunction: str, args: dict) -> str:
+        return f'{wsfunction}:{json.dumps(args, sort_keys=True, default=str)}'
+
+    def get(self, site: str, wsfunction: str, args: dict):
+        """
+        Returns the cached response, or `None` if there is no current entry.
+        """
+        if wsfunction not in self.FUNCTIONS or self.refresh:
+            return None
+        with self.lock:
+            entry = self.entries(site).get(self.key(wsfunction, args))
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+        return entry['data']
+
+    def put(self, site: str, wsfunction: str, args: dict, data):
+        if wsfunction not in self.FUNCTIONS:
+            return
+        with self.lock:
+            self.entries(site)[self.key(wsfunction, args)] = dict(
+                function=wsfunction,
+                args=json.loads(json.dumps(args, default=str)),
+                time=time.time(),
+                data=data,
+            )
+            self.dirty = True
+
+    def invalidate(self, site: str, wsfunction: str, **match):
+        """
+        Removes the entries of a function whose arguments include the given values, e.g.
+        `invalidate(site, 'core_course_get_contents', courseid=2)`.
+        """
+        with self.lock:
+            entries = self.entries(site)
+            for key, entry in list(entries.items()):
+                if entry['function'] == wsfunction and all(
+                    str(entry['args'].get(name)) == str(value)
+                    for name, value in match.items()
+                ):
+                    del entries[key]
+                    self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            now = time.time()
+            for site in self.data.values():
+                for key, entry in list(site.items()):
+                    if now - entry['time'] > self.ttl:
+                        del site[key]
+
+            write_atomic(self.path, lambda tmp: tmp.write_text(json.dumps(self.data)))
+            self.dirty = False
@@ -1,15 +1,33 @@
+from collections import defaultdict
+from functools import partial
 from pathlib import Path
+from typing import Optional
 from typing_extensions import Annotated
 
+import importlib.util
+import os
 import sys
+import time
 import typer
 
-from . import course, Mdl, CoursesFilter
+from . import course, CoursesFilter
+from .depindex import DependencyIndex
+from .images import ImageOptimizer
+from .journal import RunJournal, inputs_digest
+from .payload import prepare_module
+from .state import UploadState
+from .targets import read_targets
+from .trace import call_traced, tracer
+from .watch import watcher
 
 
 app = typer.Typer(rich_markup_mode='markdown', no_args_is_help=True)
 
 moodle = None
+# the cache of course structure, shared by all clients
+read_cache = None
+# the connection options; the client is only created (and moodlepy imported) when a command needs it
+connection = None
 
 
 def exit(*msg, code=1):
@@ -17,13 +35,105 @@ def exit(*msg, code=1):
     raise typer.Exit(code=code)
 
 
+class RenderError(Exception):
+    # raised from the exception that occurred while rendering a module, to report it as such
+    pass
+
+
+def render_module(root: Path, module, *, minify: bool = False, images: Optional[ImageOptimizer] = None):
+    # the digest of the module's inputs (see `RunJournal`) is taken before rendering, so that it
+    # can't include changes that the payload doesn't
+    inputs = inputs_digest(root, module, sorted(module.dependencies(root)), dict(minify=minify, images=images))
+    return prepare_module(root, module, minify=minify, images=images), inputs
+
+
+def needs_typst(module) -> bool:
+    # whether rendering the module compiles Typst documents
+    editors = (getattr(module, name, None) for name in ('intro', 'activity', 'page', 'summary'))
+    return any(editor is not None and editor.source.suffix == '.typ' for editor in editors)
+
+
+def render_pool(max_workers: Optional[int]):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # workers are not forked: other threads, e.g. reading manifests ahead, may hold locks that
+    # would never be released in a forked worker
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+
+# the options of commands that render modules, for optimizing their images
+OptimizeImages = Annotated[bool, typer.Option(
+    help="""
+    whether to scale down and recompress JPEG, PNG and WebP attachments and remove their
+    metadata before uploading; requires Pillow (the `images` extra)
+    """,
+    rich_help_panel="Images",
+)]
+MaxImageSize = Annotated[int, typer.Option(
+    min=1,
+    help="the maximum width and height of optimized images, in pixels",
+    rich_help_panel="Images",
+)]
+ImageQuality = Annotated[int, typer.Option(
+    min=1,
+    max=100,
+    help="the quality of optimized JPEG and WebP images",
+    rich_help_panel="Images",
+)]
+WebP = Annotated[bool, typer.Option(
+    help="""
+    whether to convert optimized images in rich text attachments to WebP; references in the
+    text are updated accordingly. Files of folders, resources and assignments keep their format.
+    """,
+    rich_help_panel="Images",
+)]
+ImageCache = Annotated[Path, typer.Option(
+    envvar="MDL_IMAGE_CACHE",
+    help="a directory storing optimized images between runs",
+    rich_help_panel="Images",
+)]
+
+
+def image_optimizer(optimize_images: bool, image_cache: Path, max_image_size: int, image_quality: int, webp: bool):
+    if not optimize_images:
+        return None
+    # Pillow is only imported by the render jobs that need it
+    if importlib.util.find_spec('PIL') is None:
+        exit("optimizing images requires Pillow; install mdl with the `images` extra")
+    return ImageOptimizer(cache=image_cache, max_size=max_image_size, quality=image_quality, webp=webp)
+
+
+def connect(base_url: str, token: str):
+    global read_cache
+    from . import Mdl
+    from .transport import Transport
+
+    url = f"{base_url}/webservice/rest/server.php"
+    transport = Transport(timeout=connection['timeout'], retries=connection['retries'])
+    if read_cache is None and connection['cache'] is not None:
+        from .cache import ReadCache
+
+        # clients of several targets share the cache, so that saving it keeps all their entries
+        read_cache = ReadCache(connection['cache'], ttl=connection['cache_ttl'], refresh=connection['refresh'])
+        connection['ctx'].call_on_close(read_cache.save)
+    return Mdl(url, token, transport, read_cache)
+
+
 def require_moodle():
+    global moodle
     if moodle is None:
-        exit(f"base-url and token are required for this command")
+        if connection['base_url'] is None or connection['token'] is None:
+            exit(f"base-url and token are required for this command")
+        moodle = connect(connection['base_url'], connection['token'])
+    return moodle
 
 
 @app.callback()
 def main(
+    ctx: typer.Context,
     base_url: Annotated[str, typer.Option(
         envvar="MOODLE_BASE_URL",
         help="the URL of your Moodle installation not including `/webservice/rest/server.php`",
@@ -36,13 +146,70 @@ def main(
         rich_help_panel="Connection",
         show_default=False,
     )]=None,
+    timeout: Annotated[float, typer.Option(
+        envvar="MOODLE_TIMEOUT",
+        help="seconds to wait for the Moodle server to connect and to respond",
+        rich_help_panel="Connection",
+    )]=60,
+    retries: Annotated[int, typer.Option(
+        envvar="MOODLE_RETRIES",
+        min=0,
+        help="""
+        how often to repeat requests that failed because of network errors or temporary server
+        errors (e.g. 502); requests that may not be repeated safely are only retried if they could
+        not be sent at all
+        """,
+        rich_help_panel="Connection",
+    )]=3,
+    cache: Annotated[Path, typer.Option(
+        envvar="MDL_CACHE",
+        help="""
+        a file caching course structure (course lists, course contents and modules) read from Moodle,
+        e.g. for listing contents or verifying modules; entries for modules that are uploaded are
+        removed from the cache
+        """,
+        rich_help_panel="Cache",
+        show_default=False,
+    )]=None,
+    cache_ttl: Annotated[float, typer.Option(
+        envvar="MDL_CACHE_TTL",
+        min=0,
+        help="how many seconds cached course structure is used",
+        rich_help_panel="Cache",
+    )]=3600,
+    refresh: Annotated[bool, typer.Option(
+        help="whether to ignore cached course structure and read it from Moodle again",
+        rich_help_panel="Cache",
+    )]=False,
+    timings: Annotated[bool, typer.Option(
+        help="whether to print how long the phases of the command took, and the slowest modules",
+        rich_help_panel="Diagnostics",
+    )]=False,
+    trace: Annotated[Path, typer.Option(
+        help="a file to write the timings of all phases to, in the Trace Event Format (e.g. for Perfetto)",
+        rich_help_panel="Diagnostics",
+        show_default=False,
+    )]=None,
 ):
     """
     Manage Moodle courses and activities.
     """
-    global moodle
-    if base_url is not None and token is not None:
-        moodle = Mdl(f'{base_url}/webservice/rest/server.php', token)
+    global connection
+    connection = dict(
+        ctx=ctx, base_url=base_url, token=token, timeout=timeout, retries=retries,
+        cache=cache, cache_ttl=cache_ttl, refresh=refresh,
+    )
+
+    if timings or trace is not None:
+        tracer.enabled = True
+
+        def report():
+            if timings:
+                print(tracer.summary(), file=sys.stderr)
+            if trace is not None:
+                tracer.write_chrome_trace(trace)
+
+        ctx.call_on_close(report)
 
 
 @app.command()
@@ -118,6 +285,81 @@ def upload(
     dry_run: Annotated[bool, typer.Option(
         help="whether to not actually upload anything",
     )]=False,
+    dependency_index: Annotated[Path, typer.Option(
+        envvar="MDL_DEPENDENCY_INDEX",
+        help="a file caching the modules' dependencies between runs",
+    )]=Path('.mdl-dependencies.json'),
+    state: Annotated[Path, typer.Option(
+        envvar="MDL_STATE",
+        help="""
+        A file recording a digest of each module's content after it was successfully uploaded.
+        Modules whose content (including attachments) did not change since then are skipped.
+        """,
+    )]=Path('.mdl-state.json'),
+    force: Annotated[bool, typer.Option(
+        help="whether to upload modules even if their content did not change since the last upload",
+    )]=False,
+    jobs: Annotated[int, typer.Option(
+        min=1,
+        help="the number of modules to prepare and upload concurrently",
+    )]=1,
+    progress: Annotated[bool, typer.Option(
+        help="whether to report the progress and speed of file uploads",
+    )]=False,
+    render_jobs: Annotated[Optional[int], typer.Option(
+        min=1,
+        help="""
+        the number of processes used for compiling Typst documents ahead of the uploads; defaults to
+        the number of CPUs. With 1, and for other sources, modules are rendered by the upload jobs.
+        """,
+        show_default=False,
+    )]=None,
+    keep_going: Annotated[bool, typer.Option(
+        "--keep-going/--fail-fast",
+        help="whether to continue with the remaining modules after one of them failed",
+    )]=True,
+    journal: Annotated[Path, typer.Option(
+        envvar="MDL_JOURNAL",
+        help="""
+        A file recording the modules completed by the current run; it is removed when the run
+        completes without failures.
+        """,
+    )]=Path('.mdl-journal.jsonl'),
+    resume: Annotated[bool, typer.Option(
+        help="""
+        whether to continue an interrupted or failed run: modules recorded in the `--journal` are
+        skipped without rendering them, unless their definition, files or rendering options changed
+        """,
+    )]=False,
+    only_different: Annotated[bool, typer.Option(
+        help="""
+        whether to compare each module with its current content on Moodle (see `diff` command), and
+        only upload it if it differs; this also detects edits made in Moodle, and ignores the
+        `--state` file and `--force`
+        """,
+    )]=False,
+    targets: Annotated[Path, typer.Option(
+        help="""
+        A YAML file listing the courses to upload to, on this or other Moodle sites, and how the IDs
+        in the manifests map to each course's IDs. Each module is rendered once for all targets.
+        """,
+        show_default=False,
+    )]=None,
+    batch_size: Annotated[int, typer.Option(
+        min=1,
+        help="""
+        the maximum number of module updates sent in one request, if Moodle allows batching calls
+        through `tool_mobile_call_external_functions`; with 1, every module is updated separately
+        """,
+    )]=50,
+    minify: Annotated[bool, typer.Option(
+        help="whether to remove comments and collapse whitespace in HTML content, e.g. compiled Typst documents",
+    )]=False,
+    optimize_images: OptimizeImages=False,
+    max_image_size: MaxImageSize=2048,
+    image_quality: ImageQuality=85,
+    webp: WebP=False,
+    image_cache: ImageCache=Path('.mdl-images'),
 ):
     """
     Uploads one or more modules to Moodle. Each module is specified as a file.
@@ -141,34 +383,606 @@ def upload(
 
     File paths are always resolved relative to the specified file. For self-contained files, that
     means a self-reference can always be written as a file name without a path component.
+
+
+
+    After each successful upload, a digest of the module's content is recorded in the `--state`
+    file. Later uploads of the same content to the same Moodle installation are skipped unless
+    `--force` is given.
+
+
+
+    Reading manifests, rendering (compiling Typst documents on `--render-jobs` processes) and
+    uploading overlap, so the first modules are uploaded while later manifests are still being read.
+    With `--jobs`, several modules are uploaded at the same time; results are still reported in the
+    order of the manifests. By default, failures are reported as they occur and summarized at
+    the end; `--fail-fast` stops at the first failure.
+
+
+
+    While uploading, completed modules are recorded in the `--journal`. If the run is interrupted
+    or some modules fail, `--resume` continues it: modules completed before are skipped unless
+    their inputs changed.
     """
-    if verify or not dry_run:
-        require_moodle()
+    images = image_optimizer(optimize_images, image_cache, max_image_size, image_quality, webp)
+
+    # the clients to upload to, with the target mapping IDs for each; without `--targets`, IDs are
+    # used as they are
+    destinations = []
+    if targets is not None:
+        try:
+            targets = read_targets(targets)
+        except course.CourseException as ex:
+            exit(*ex.args)
+        if verify or not dry_run:
+            for target in targets:
+                # by default, targets are on the site given by the connection options
+                base_url = target.base_url or connection['base_url']
+                token = target.token or connection['token']
+                if base_url is None or token is None:
+                    exit(f"target {target.name}: base-url and token are required")
+                destinations.append((target, connect(base_url, token)))
+    elif verify or not dry_run:
+        destinations.append((None, require_moodle()))
+
+    def label(name, target):
+        return name if target is None else f"{name} [{target.name}]"
 
     if changes is not None:
-        with open(changes, 'rt') as f:
+        with open(changes, 'rt', encoding='utf-8') as f:
             changes = set(Path(line.rstrip('\r\n')).resolve() for line in f)
+    if changes is not None or resume:
+        index = DependencyIndex(dependency_index)
+
+    if not dry_run:
+        state = UploadState(state, destinations[0][1].url)
+        # with targets, the journal belongs to the set of targets, identified by their names and
+        # sites; not by their tokens, which would be written to the journal and may be rotated
+        run = destinations[0][1].url
+        if targets is not None:
+            run = ' '.join(f'{target.name}={client.url}' for target, client in destinations)
+        journal = RunJournal(journal, run, resume=resume)
+        # the state of each destination, which may be on another site
+        states = [state.for_site(client.url) for _, client in destinations]
+        for _, client in destinations:
+            client.batch_size = batch_size
+
+    if progress and not dry_run:
+        last_report = {}
+
+        def report_progress(label, sent, total, elapsed):
+            # report at most once per second per upload, and when an upload is complete
+            now = time.monotonic()
+            if sent < total and now - last_report.get(label, 0) < 1:
+                return
+            last_report[label] = now
+            rate = sent / elapsed if elapsed > 0 else 0
+            print(f"  {label}: {sent / 2**20:.1f} of {total / 2**20:.1f} MiB ({rate / 2**20:.1f} MiB/s)", file=sys.stderr)
+
+        for _, client in destinations:
+            client.upload_progress = report_progress
+
+    from collections import deque
+    from concurrent.futures import CancelledError, ThreadPoolExecutor
+    from contextlib import ExitStack
+
+    def render_in_thread(name, root, module):
+        # like rendering in a process (see `call_traced`), but events are recorded directly
+        with tracer.module(name):
+            return render_module(root, module, minify=minify, images=images), []
+
+    def add_events(rendered):
+        if not rendered.cancelled() and rendered.exception() is None:
+            _, events = rendered.result()
+            with tracer.lock:
+                tracer.events.extend(events)
+
+    def verify_target(target, verifier, module):
+        meta = target.map_meta(module)
+        if isinstance(meta, course.ModuleMeta):
+            verifier.verify_module(meta)
+        else:
+            verifier.verify_section(meta)
+
+    def upload_module(name, root, module, rendered, target, client, verifier, state):
+        with tracer.module(name):
+            if rendered is None:
+                payload, inputs = render_module(root, module, minify=minify, images=images)
+            else:
+                try:
+                    (payload, inputs), _ = rendered.result()
+                except CancelledError:
+                    raise
+                except Exception as ex:
+                    raise RenderError() from ex
+
+            if target is not None:
+                # the rendered payload is shared by all targets; only the IDs differ
+                if verifier is not None:
+                    verify_target(target, verifier, module)
+                payload = target.map_payload(payload)
+
+            digest = payload.digest()
+            if only_different:
+                # the content on Moodle may have been edited, so the state file is not consulted
+                if not client.remote_differences(payload):
+                    return payload, inputs, digest, "the content on Moodle is the same", None
+            elif not force:
+                if state.is_current(payload.key, digest):
+                    return payload, inputs, digest, "the content is unchanged since the last upload", None
+                if client.remote_files_match(payload):
+                    return payload, inputs, digest, "the files on Moodle are up to date", None
+            # draft areas are only shared between identical file sets, so concurrent uploads can't mix up files
+            return payload, inputs, digest, None, client.submit_payload(payload)
+
+    # modules that are being rendered or uploaded, in input order. Their number is bounded, so that
+    # manifests are only read as far ahead as rendering and uploading can make use of them
+    in_flight = deque()
+    window = 4 * max(jobs, render_jobs or os.cpu_count() or 1)
+    # with targets, modules are verified against each target instead of the manifests' IDs
+    metas = course.iter_metas(modules, verify_with=moodle if verify and targets is None else None, ahead=window)
+    verifiers = [
+        course.Verifier(client) if verify and target is not None else None
+        for target, client in destinations
+    ]
+    total = 0
+    failures = []
+
+    with ExitStack() as stack:
+        if changes is not None or resume:
+            stack.callback(index.save)
+        uploader = stack.enter_context(ThreadPoolExecutor(max_workers=jobs))
+        renderer = None
+
+        def cancel():
+            uploader.shutdown(cancel_futures=True)
+            if renderer is not None:
+                renderer.shutdown(cancel_futures=True)
+
+        def report(name, future, state):
+            # results are reported in input order, regardless of the order in which uploads finish
+            try:
+                payload, inputs, digest, skipped, response = future.result()
+                # the update itself may still be waiting to be sent in a batch
+                result = response.result() if response is not None else None
+            except CancelledError:
+                return
+            except RenderError as ex:
+                message = f"error while rendering {name}: {ex.__cause__}"
+            except Exception as ex:
+                message = f"error while processing {name}: {ex}"
+            else:
+                if skipped is not None:
+                    print(f"{name}: skipping because {skipped}")
+                    if not state.is_current(payload.key, digest):
+                        state.record(payload.key, digest)
+                        state.save()
+                    journal.record(name, payload.key, inputs, digest)
+                    return
+                if result == 'ok':
+                    print(f"{name}: uploaded")
+                    state.record(payload.key, digest)
+                    state.save()
+                    journal.record(name, payload.key, inputs, digest)
+                    return
+                message = f"unexpected response while processing {name}: {result}"
+            fail(name, message)
+
+        def fail(name, message):
+            if not keep_going:
+                cancel()
+                exit(message)
+            print(message, file=sys.stderr)
+            failures.append(name)
+
+        while True:
+            try:
+                entry = next(metas, None)
+            except Exception as ex:
+                # a malformed manifest still aborts the upload; modules that were already started
+                # are reported before exiting
+                cancel()
+                while in_flight:
+                    report(*in_flight.popleft())
+                if isinstance(ex, course.CourseException):
+                    exit(*ex.args)
+                raise
+            if entry is None:
+                break
+
+            name, root, module = entry
+            if changes is not None and not index.is_affected(name, root, module, changes):
+                print(f"{name}: skipping because no modifications were found")
+                continue
+
+            if dry_run:
+                # modules are still verified against each target
+                for (target, _), verifier in zip(destinations, verifiers):
+                    if verifier is not None:
+                        total += 1
+                        try:
+                            verify_target(target, verifier, module)
+                        except Exception as ex:
+                            fail(label(name, target), f"error while processing {label(name, target)}: {ex}")
+                print(f"{name}: performing a dry-run, upload is skipped")
+                continue
+
+            pending = list(zip(destinations, verifiers, states))
+            if resume:
+                try:
+                    inputs = inputs_digest(root, module, index.dependencies(name, root, module), dict(minify=minify, images=images))
+                except Exception:
+                    # e.g. a Typst source that can't be queried; rendering will report the error
+                    inputs = None
+                for destination in list(pending):
+                    (target, _), _, _ = destination
+                    if journal.is_complete(label(name, target), inputs):
+                        print(f"{label(name, target)}: skipping because it was completed by the resumed run")
+                        pending.remove(destination)
+                if not pending:
+                    continue
+
+            rendered = None
+            if render_jobs != 1 and needs_typst(module):
+                if renderer is None:
+                    # Typst documents are compiled in separate processes, so that uploads don't have
+                    # to wait for the CPU-heavy part; the processes are started once they're needed
+                    renderer = stack.enter_context(render_pool(render_jobs))
+                rendered = renderer.submit(call_traced, tracer.enabled, name, partial(render_module, minify=minify, images=images), root, module)
+            elif len(pending) > 1:
+                # render once for all destinations
+                rendered = uploader.submit(render_in_thread, name, root, module)
+            if rendered is not None:
+                rendered.add_done_callback(add_events)
+            for ((target, client), verifier, state) in pending:
+                total += 1
+                future = uploader.submit(upload_module, name, root, module, rendered, target, client, verifier, state)
+                in_flight.append((label(name, target), future, state))
+            while len(in_flight) >= window:
+                report(*in_flight.popleft())
+
+        while in_flight:
+            report(*in_flight.popleft())
+
+    if not dry_run:
+        journal.close(complete=not failures)
+    if failures and dry_run:
+        exit(f"failed to verify {len(failures)} of {total} modules")
+    if failures:
+        exit(f"failed to render or upload {len(failures)} of {total} modules; use `--resume` to retry them")
+
+
+@app.command()
+def watch(
+    modules: Annotated[list[Path], typer.Argument(
+        help="the manifests specifying the modules to watch",
+        show_default=False,
+    )],
+    verify: Annotated[bool, typer.Option(
+        help="whether to verify the module type and course before uploading a module",
+    )]=True,
+    state: Annotated[Path, typer.Option(
+        envvar="MDL_STATE",
+        help="the file recording the digests of uploaded modules (see `upload`)",
+    )]=Path('.mdl-state.json'),
+    debounce: Annotated[float, typer.Option(
+        help="how many seconds to wait for further changes before uploading",
+    )]=0.2,
+    polling: Annotated[bool, typer.Option(
+        help="whether to detect changes by polling instead of using file system events",
+    )]=False,
+    minify: Annotated[bool, typer.Option(
+        help="whether to remove comments and collapse whitespace in HTML content, e.g. compiled Typst documents",
+    )]=False,
+    optimize_images: OptimizeImages=False,
+    max_image_size: MaxImageSize=2048,
+    image_quality: ImageQuality=85,
+    webp: WebP=False,
+    image_cache: ImageCache=Path('.mdl-images'),
+):
+    """
+    Watches the specified modules and uploads them whenever one of their dependencies (see
+    `dependencies` command) changes. The input files are the same types as accepted by the `upload`
+    command.
+
+    When a manifest changes, the modules are read again, and modules whose definition changed are
+    uploaded as well. Modules whose content is the same as at their last upload are skipped.
+    """
+    require_moodle()
+    state = UploadState(state, moodle.url)
+    images = image_optimizer(optimize_images, image_cache, max_image_size, image_quality, webp)
+
+    def build():
+        manifests = set()
+        metas = course.collect_metas(modules, verify_with=moodle if verify else None, manifests=manifests)
+        graph = defaultdict(list)
+        for entry in metas:
+            name, root, module = entry
+            for dep in module.dependencies(root):
+                graph[dep.resolve()].append(entry)
+        return {m.resolve() for m in manifests}, metas, graph
+
+    def upload_modules(entries):
+        # draft areas are only shared within one pass; older ones may have been deleted by now
+        moodle.forget_drafts()
+        for name, root, module in entries:
+            try:
+                with tracer.module(name):
+                    payload = prepare_module(root, module, minify=minify, images=images)
+                    digest = payload.digest()
+                    if state.is_current(payload.key, digest):
+                        continue
+
+                    result = moodle.upload_payload(payload)
+            except Exception as ex:
+                print(f"error while processing {name}: {ex}", file=sys.stderr)
+                continue
+
+            if result != 'ok':
+                print(f"unexpected response while processing {name}: {result}", file=sys.stderr)
+                continue
+            print(f"{name}: uploaded")
+            state.record(payload.key, digest)
+            state.save()
 
     try:
-        modules = course.collect_metas(modules, verify_with=moodle if verify else None)
+        manifests, metas, graph = build()
     except course.CourseException as ex:
         exit(*ex.args)
 
-    for name, root, module in modules:
-        if changes is not None:
-            dependencies = {p.resolve() for p in module.dependencies(root)}
-            if dependencies.isdisjoint(changes):
-                print(f"{name}: skipping because no modifications were found")
+    w = watcher(debounce=debounce, polling=polling)
+    try:
+        while True:
+            w.watch(manifests | graph.keys())
+            changed = w.wait()
+
+            affected = set()
+            if not changed.isdisjoint(manifests):
+                previous = {name: module for name, _, module in metas}
+                try:
+                    manifests, metas, graph = build()
+                except Exception as ex:
+                    # keep watching with the old modules until the manifest is fixed
+                    print(f"error while reading manifests: {ex}", file=sys.stderr)
+                    continue
+                affected.update(name for name, _, module in metas if previous.get(name) != module)
+
+            for path in changed:
+                affected.update(name for name, _, _ in graph.get(path, []))
+
+            upload_modules(entry for entry in metas if entry[0] in affected)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        w.close()
+
+
+@app.command()
+def diff(
+    modules: Annotated[list[Path], typer.Argument(
+        help="the manifests specifying the modules to compare",
+        show_default=False,
+    )],
+    minify: Annotated[bool, typer.Option(
+        help="whether HTML content is minified, as with `upload --minify`",
+    )]=False,
+    optimize_images: OptimizeImages=False,
+    max_image_size: MaxImageSize=2048,
+    image_quality: ImageQuality=85,
+    webp: WebP=False,
+    image_cache: ImageCache=Path('.mdl-images'),
+):
+    """
+    Compares the specified modules with their current content on Moodle, and lists the modules that
+    differ. The input files are the same types as accepted by the `upload` command.
+
+    Texts are compared after normalizing whitespace and HTML serialization; files are compared by
+    their names and sizes. The current content is fetched in bulk, with one request per course and
+    module type. Exits with status 1 if any module differs.
+
+    Images are compared as they would be uploaded; pass the same image options as to `upload`.
+    """
+    require_moodle()
+    images = image_optimizer(optimize_images, image_cache, max_image_size, image_quality, webp)
+
+    different = 0
+    try:
+        for name, root, module in course.iter_metas(modules):
+            with tracer.module(name):
+                payload = prepare_module(root, module, minify=minify, images=images)
+                parts = moodle.remote_differences(payload)
+            if parts:
+                different += 1
+                print(f"{name}: differs ({', '.join(parts)})")
+            else:
+                print(f"{name}: same")
+    except course.CourseException as ex:
+        exit(*ex.args)
+
+    if different:
+        exit(f"{different} modules differ", code=1)
+
+
+@app.command()
+def build(
+    modules: Annotated[list[Path], typer.Argument(
+        help="the manifests specifying the modules to render",
+        show_default=False,
+    )],
+    artifacts: Annotated[Path, typer.Option(
+        envvar="MDL_ARTIFACTS",
+        help="the directory storing rendered modules and their files",
+    )]=Path('.mdl-build'),
+    dependency_index: Annotated[Path, typer.Option(
+        envvar="MDL_DEPENDENCY_INDEX",
+        help="a file caching the modules' dependencies between runs",
+    )]=Path('.mdl-dependencies.json'),
+    render_jobs: Annotated[Optional[int], typer.Option(
+        min=1,
+        help="the number of processes used for compiling Typst documents; defaults to the number of CPUs",
+        show_default=False,
+    )]=None,
+    minify: Annotated[bool, typer.Option(
+        help="whether to remove comments and collapse whitespace in HTML content, e.g. compiled Typst documents",
+    )]=False,
+    optimize_images: OptimizeImages=False,
+    max_image_size: MaxImageSize=2048,
+    image_quality: ImageQuality=85,
+    webp: WebP=False,
+    image_cache: ImageCache=Path('.mdl-images'),
+):
+    """
+    Renders the specified modules (see `upload`) without uploading them, and stores the results in
+    the `--artifacts` directory, from which `publish` uploads them; e.g. to render in one CI job
+    and upload from another, or from a machine without Typst.
+
+    Rendered modules are stored under a key derived from the module definition, the content of its
+    dependencies (see `dependencies` command) and the rendering options. Modules whose key is
+    already in the directory are not rendered again, so keeping the directory between builds (e.g.
+    in a CI cache) makes unchanged modules free.
+    """
+    from contextlib import ExitStack
+    from .artifacts import ArtifactStore
+
+    images = image_optimizer(optimize_images, image_cache, max_image_size, image_quality, webp)
+    store = ArtifactStore(artifacts)
+    index = DependencyIndex(dependency_index)
+    options = dict(minify=minify, images=images)
+
+    try:
+        metas = course.collect_metas(modules)
+    except course.CourseException as ex:
+        exit(*ex.args)
+
+    built = []
+    failures = 0
+    with ExitStack() as stack:
+        renderer = None
+        entries = []
+        for name, root, module in metas:
+            try:
+                key = store.key(root, module, index.dependencies(name, root, module), options)
+            except Exception as ex:
+                # e.g. a missing attachment, or a Typst source that can't be queried
+                print(f"error while rendering {name}: {ex}", file=sys.stderr)
+                failures += 1
                 continue
+            rendered = None
+            if not store.has(key) and needs_typst(module):
+                if renderer is None:
+                    renderer = stack.enter_context(render_pool(render_jobs))
+                rendered = renderer.submit(call_traced, tracer.enabled, name, partial(prepare_module, minify=minify, images=images), root, module)
+            entries.append((name, root, module, key, rendered))
+        index.save()
+
+        for name, root, module, key, rendered in entries:
+            if rendered is None and store.has(key):
+                print(f"{name}: reusing the stored artifact")
+            else:
+                try:
+                    if rendered is None:
+                        # other modules are cheap to render; they are rendered here while Typst
+                        # documents are compiled
+                        with tracer.module(name):
+                            payload = prepare_module(root, module, minify=minify, images=images)
+                    else:
+                        payload, events = rendered.result()
+                        with tracer.lock:
+                            tracer.events.extend(events)
+                except Exception as ex:
+                    print(f"error while rendering {name}: {ex}", file=sys.stderr)
+                    failures += 1
+                    continue
+                store.write(key, payload)
+                print(f"{name}: rendered")
+            built.append((name, key))
+
+    if failures:
+        exit(f"failed to render {failures} of {len(metas)} modules")
+    store.write_build(built)
+
+
+@app.command()
+def publish(
+    artifacts: Annotated[Path, typer.Option(
+        envvar="MDL_ARTIFACTS",
+        help="the directory containing the output of `build`",
+    )]=Path('.mdl-build'),
+    state: Annotated[Path, typer.Option(
+        envvar="MDL_STATE",
+        help="the file recording the digests of uploaded modules (see `upload`)",
+    )]=Path('.mdl-state.json'),
+    force: Annotated[bool, typer.Option(
+        help="whether to upload modules even if their content did not change since the last upload",
+    )]=False,
+    jobs: Annotated[int, typer.Option(
+        min=1,
+        help="the number of modules to upload concurrently",
+    )]=1,
+    keep_going: Annotated[bool, typer.Option(
+        "--keep-going/--fail-fast",
+        help="whether to continue with the remaining modules after one of them failed",
+    )]=True,
+    batch_size: Annotated[int, typer.Option(
+        min=1,
+        help="the maximum number of module updates sent in one request (see `upload`)",
+    )]=50,
+):
+    """
+    Uploads the modules rendered by the last `build`, without reading the manifests or rendering
+    anything. Skipping unchanged modules works as in `upload`, and shares its `--state` file.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from .artifacts import ArtifactStore
+
+    require_moodle()
+    store = ArtifactStore(artifacts)
+    try:
+        modules = store.read_build()
+    except FileNotFoundError:
+        exit(f"{artifacts} does not contain a build; run `mdl build` first")
+    except ValueError as ex:
+        exit(*ex.args)
+
+    state = UploadState(state, moodle.url)
+    moodle.batch_size = batch_size
+
+    def publish_module(name, key):
+        with tracer.module(name):
+            payload = store.read(key)
+            digest = payload.digest()
+            if not force:
+                if state.is_current(payload.key, digest):
+                    return payload, digest, "the content is unchanged since the last upload", None
+                if moodle.remote_files_match(payload):
+                    return payload, digest, "the files on Moodle are up to date", None
+            return payload, digest, None, moodle.submit_payload(payload)
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=jobs) as uploader:
+        futures = [(name, uploader.submit(publish_module, name, key)) for name, key in modules]
+        for name, future in futures:
+            try:
+                payload, digest, skipped, response = future.result()
+                result = response.result() if response is not None else None
+            except Exception as ex:
+                message = f"error while processing {name}: {ex}"
+            else:
+                if skipped is not None or result == 'ok':
+                    print(f"{name}: {'skipping because ' + skipped if skipped is not None else 'uploaded'}")
+                    state.record(payload.key, digest)
+                    state.save()
+                    continue
+                message = f"unexpected response while processing {name}: {result}"
 
-        if dry_run:
-            print(f"{name}: performing a dry-run, upload is skipped")
-            continue
+            if not keep_going:
+                uploader.shutdown(cancel_futures=True)
+                exit(message)
+            print(message, file=sys.stderr)
+            failures += 1
 
-        print(f"{name}: uploading...")
-        result = moodle.upload_module(root, module)
-        if result != 'ok':
-            exit(f"unexpected response while processing {name}: {result}")
+    if failures:
+        exit(f"failed to upload {failures} of {len(modules)} modules")
 
 
 @app.command()
@@ -180,6 +994,10 @@ def dependencies(
     sort: Annotated[bool, typer.Option(
         help="whether to print the files in alphabetical order",
     )]=False,
+    dependency_index: Annotated[Path, typer.Option(
+        envvar="MDL_DEPENDENCY_INDEX",
+        help="a file caching the modules' dependencies between runs",
+    )]=Path('.mdl-dependencies.json'),
 ):
     """
     Lists files that contribute content to the specified modules. The input files are the same types
@@ -199,9 +1017,11 @@ def dependencies(
     except course.CourseException as ex:
         exit(*ex.args)
 
+    index = DependencyIndex(dependency_index)
     dependencies = set()
     for name, root, module in modules:
-        dependencies.update(module.dependencies(root))
+        dependencies.update(index.dependencies(name, root, module))
+    index.save()
 
     if sort:
         dependencies = sorted(dependencies)
@@ -0,0 +1,300 @@
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+import threading
+import time
+
+from . import CoursesFilter
+from .cache import ReadCache
+from .course import ModuleMeta, SectionMeta
+from .diff import RemoteContents, differences
+from .moodle import BatchedModContentService, Moodle
+from .payload import ModulePayload, UploadFile, file_hash, prepare_module
+from .trace import tracer
+from .transport import Transport
+
+
+class Mdl(Moodle):
+    def __init__(self, url: str, token: str, transport: Transport=None, cache: ReadCache=None):
+        super(Mdl, self).__init__(url, token, transport, cache)
+        # course contents fetched for comparing files, by course ID
+        self._contents = {}
+        # draft areas uploaded during this run, by their files' names and content hashes
+        self._drafts = {}
+        self._drafts_lock = threading.Lock()
+        # the maximum number of module updates sent in one request; 1 disables batching
+        self.batch_size = 1
+        # the maximum number of directories of a draft area uploaded at the same time
+        self.draft_jobs = 8
+        self._batcher = None
+        self._batcher_lock = threading.Lock()
+        # current module contents on Moodle, for comparing with local content
+        self._remote = None
+        self._remote_lock = threading.Lock()
+
+    def get_courses(self, filter=CoursesFilter.editable):
+        match filter:
+            case CoursesFilter.enrolled:
+                return self.core.course.search_courses("search", "", limittoenrolled=1)
+            case CoursesFilter.editable:
+                return self.core.course.search_courses("search", "", requiredcapabilities=['moodle/course:manageactivities'])
+
+    def get_course_contents(self, courseid):
+        return self.core.course.get_contents(courseid)
+
+    def get_course_module(self, cmid, courseid=None):
+        module = self.core.course.get_course_module(cmid)
+        if courseid is not None and module.cm.course != courseid:
+            raise ValueError("cmid does not belong to the given course")
+        return module
+
+    def upload_files(self, files: list[UploadFile]):
+        if len(files) == 0:
+            return None
+
+        # a draft area is not consumed by using it, so identical file sets only need to be uploaded once
+        key = tuple((str(dest), file_hash(f)) for dest, f in files)
+        with self._drafts_lock:
+            draft = self._drafts.get(key)
+            if draft is None:
+                draft = self._drafts[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            # another module is (or was) uploading the same files
+            return draft.result()
+
+        try:
+            itemid = self._upload_draft(files)
+        except BaseException as ex:
+            with self._drafts_lock:
+                del self._drafts[key]
+            draft.set_exception(ex)
+            raise
+        draft.set_result(itemid)
+        return itemid
+
+    def forget_drafts(self):
+        """
+        Stops reusing the draft areas uploaded so far, e.g. between the upload passes of a
+        long-running process: Moodle eventually deletes draft areas.
+        """
+        with self._drafts_lock:
+            self._drafts.clear()
+
+    def _upload_draft(self, files: list[UploadFile]):
+        batches = defaultdict(list)
+        for dest, f in files:
+            batch = str(PurePosixPath('/')/dest.parent)
+            if batch != '/':
+                # moodle requires trailing slashes
+                batch += '/'
+            # now we have
+            # - a batch with leading and trailing slash, e.g. /, /a/, /a/b/
+            # - a name that is only the name component of the full file path
+            # - a file f that can be opened directly
+            batches[batch].append((dest.name, f))
+
+        pending = list(batches.items())
+        itemid = self.new_draft_itemid() if len(pending) > 1 else None
+        # directories that exist in the draft area
+        created = set()
+        if itemid is None:
+            # the first upload creates the draft area
+            path, batch = pending.pop(0)
+            itemid = self.upload_draft(batch, itemid=0, filepath=path)
+            created.update(_directories(path))
+
+        # each upload can only contain files of one directory. These uploads are sent concurrently,
+        # except for uploads that would create the same missing directory, which Moodle can't do at
+        # the same time; these are deferred to a later wave
+        while pending:
+            wave, deferred, claimed = [], [], set()
+            for path, batch in pending:
+                missing = _directories(path) - created
+                if missing & claimed:
+                    deferred.append((path, batch))
+                else:
+                    claimed |= missing
+                    wave.append((path, batch))
+            with ThreadPoolExecutor(max_workers=min(self.draft_jobs, len(wave))) as executor:
+                for future in [executor.submit(self.upload_draft, batch, itemid=itemid, filepath=path) for path, batch in wave]:
+                    future.result()
+            created |= claimed
+            pending = deferred
+        return itemid
+
+    def upload_payload(self, payload: ModulePayload):
+        return self.submit_payload(payload).result()
+
+    def submit_payload(self, payload: ModulePayload) -> Future:
+        """
+        Uploads the payload's files, and then updates the module or section. If batching is enabled
+        and supported by Moodle, the update is queued and sent together with other updates; the
+        returned future is resolved with the update's result.
+        """
+        with tracer.span('upload'):
+            function, args = self._prepare_update(payload)
+
+            if self.batch_size > 1 and self.batched_modcontentservice is not None:
+                with self._batcher_lock:
+                    if self._batcher is None:
+                        self._batcher = _UpdateBatcher(self.batched_modcontentservice, self.batch_size)
+                future = self._batcher.submit(function, args)
+            else:
+                future = Future()
+                try:
+                    future.set_result(getattr(self.modcontentservice, function)(**args))
+                except Exception as ex:
+                    future.set_exception(ex)
+
+        future.add_done_callback(lambda _: self._invalidate(payload))
+        return future
+
+    def _invalidate(self, payload: ModulePayload):
+        # the module's files are not the same as before anymore
+        self._contents.pop(payload.course, None)
+        if self.cache is not None:
+            if payload.course is not None:
+                self.cache.invalidate(self.cache_site, 'core_course_get_contents', courseid=payload.course)
+            else:
+                self.cache.invalidate(self.cache_site, 'core_course_get_contents')
+            if 'cmid' in payload.target:
+                self.cache.invalidate(self.cache_site, 'core_course_get_course_module', cmid=payload.target['cmid'])
+
+    def _prepare_update(self, payload: ModulePayload) -> tuple[str, dict]:
+        args = dict(payload.target)
+        for name, editor in payload.editors.items():
+            if editor is None:
+                args[name] = None
+                continue
+
+            value = dict(text=editor.text, format=editor.format)
+            itemid = self.upload_files(editor.files)
+            if itemid is not None:
+                value['itemid'] = itemid
+            args[name] = value
+        for name, files in payload.files.items():
+            args[name] = self.upload_files(files)
+
+        return payload.function, args
+
+    def remote_files_match(self, payload: ModulePayload) -> bool:
+        """
+        Checks whether Moodle already has the payload's files, in case the payload consists only of
+        files. Files match if Moodle reports the same names and sizes, and they were uploaded after
+        the local files were last modified.
+        """
+        if payload.function not in ('update_folder_content', 'update_resource_content'):
+            # only these modules' files are reported in the course contents
+            return False
+        if payload.course is None or any(editor is not None for editor in payload.editors.values()):
+            return False
+
+        if payload.course not in self._contents:
+            self._contents[payload.course] = self.get_course_contents(payload.course)
+        remote = None
+        for section in self._contents[payload.course]:
+            for cm in section.modules:
+                if cm.id == payload.target['cmid']:
+                    remote = {
+                        f'{content.filepath or "/"}{content.filename}': content
+                        for content in cm.contents or []
+                        if content.type == 'file'
+                    }
+        if remote is None:
+            return False
+
+        local = {
+            f'/{dest}': f
+            for files in payload.files.values()
+            for dest, f in files
+        }
+        if remote.keys() != local.keys():
+            return False
+        for name, f in local.items():
+            stat = f.stat()
+            content = remote[name]
+            if content.filesize != stat.st_size:
+                return False
+            if content.timemodified is None or stat.st_mtime > content.timemodified.timestamp():
+                return False
+        return True
+
+    def remote_differences(self, payload: ModulePayload) -> list[str]:
+        """
+        Compares the payload with the module's or section's current content on Moodle, see
+        `diff.differences`. Contents are fetched in bulk per course and module type.
+        """
+        with self._remote_lock:
+            if self._remote is None:
+                self._remote = RemoteContents(self)
+        with tracer.span('diff'):
+            return differences(payload, self._remote.get(payload))
+
+    def upload_module(self, root: Path, module: ModuleMeta | SectionMeta):
+        return self.upload_payload(prepare_module(root, module))
+
+
+class _UpdateBatcher:
+    """
+    Collects module updates from several threads and sends them in batches from a background
+    thread. A batch is sent when it is full, or shortly after its first update was submitted, so
+    that updates that trickle in are not delayed much.
+    """
+
+    def __init__(self, service: BatchedModContentService, size: int, delay: float = 0.05):
+        self.service = service
+        self.size = size
+        self.delay = delay
+        self.pending = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='mdl-update-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, function: str, args: dict) -> Future:
+        future = Future()
+        with self.condition:
+            self.pending.append((function, args, future))
+            self.condition.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = time.monotonic() + self.delay
+                while len(self.pending) < self.size and (remaining := deadline - time.monotonic()) > 0:
+                    self.condition.wait(remaining)
+                batch, self.pending = self.pending[:self.size], self.pending[self.size:]
+            self._send(batch)
+
+    def _send(self, batch):
+        calls = [(function, args) for function, args, _ in batch]
+        try:
+            with tracer.span('batch update', updates=len(batch)):
+                results = self.service.update(calls)
+        except Exception:
+            # the batch as a whole was rejected or failed, e.g. because of a server error after
+            # retrying; fall back to updating one module at a time
+            results = []
+            for function, args in calls:
+                try:
+                    results.append(getattr(self.service.moodle.modcontentservice, function)(**args))
+                except Exception as ex:
+                    results.append(ex)
+
+        for (_, _, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def _directories(path: str) -> set[str]:
+    # the directories that an upload to `path` (e.g. `/a/b/`) creates if they don't exist. This
+    # includes the root directory: the first upload to a new draft area creates its root record
+    parts = path.strip('/').split('/') if path != '/' else []
+    return {'/', *('/' + '/'.join(parts[:i]) + '/' for i in range(1, len(parts) + 1))}
@@ -1,11 +1,12 @@
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
+import copy
+import os
+import threading
 
-from moodle.core.course import ContentOption
-from ruamel.yaml import YAML
-
-from . import typst
+from . import sources, typst
+from .trace import tracer
 
 
 class CourseException(Exception):
@@ -67,19 +68,21 @@ class ModuleMeta:
     intro: Optional[EditorContent] = None
 
     def __new__(cls, *args, **kwargs):
-        match kwargs['mod']:
-            case 'assign':
-                cls = AssignMeta
-            case 'folder':
-                cls = FolderMeta
-            case 'label':
-                cls = LabelMeta
-            case 'page':
-                cls = PageMeta
-            case 'resource':
-                cls = ResourceMeta
-            case _:
-                raise AssertionError("Unknown ModuleMeta class")
+        # unpickling creates instances of the concrete subclass without any arguments
+        if cls is ModuleMeta:
+            match kwargs['mod']:
+                case 'assign':
+                    cls = AssignMeta
+                case 'folder':
+                    cls = FolderMeta
+                case 'label':
+                    cls = LabelMeta
+                case 'page':
+                    cls = PageMeta
+                case 'resource':
+                    cls = ResourceMeta
+                case _:
+                    raise AssertionError("Unknown ModuleMeta class")
         return super().__new__(cls)
 
     def __post_init__(self):
@@ -163,46 +166,152 @@ class ResourceMeta(ModuleMeta):
         return dependencies
 
 
-def collect_metas(modules: list[Path], verify_with=None) -> list[tuple[Path, ModuleMeta | SectionMeta]]:
+class Verifier:
+    """
+    Checks metas against the actual course contents. Each course's contents are fetched only once
+    and are then used to verify all modules and sections that are supposed to be in that course.
+    """
+
+    def __init__(self, moodle):
+        self.moodle = moodle
+        self.courses = {}
+
+    def course(self, courseid: int):
+        if courseid not in self.courses:
+            with tracer.span('verify', course=courseid):
+                sections = self.moodle.get_course_contents(courseid)
+            self.courses[courseid] = (
+                {section.id for section in sections},
+                {cm.id: cm.modname for section in sections for cm in section.modules},
+            )
+        return self.courses[courseid]
+
+    def verify_module(self, meta: ModuleMeta):
+        if meta.course is not None:
+            _, modules = self.course(meta.course)
+            modname = modules.get(meta.cmid)
+            course = meta.course
+        else:
+            modname = None
+
+        if modname is None:
+            # no expected course, or the module is not in it: look it up individually
+            with tracer.span('verify', cmid=meta.cmid):
+                cm = self.moodle.get_course_module(meta.cmid).cm
+            modname, course = cm.modname, cm.course
+
+        if modname != meta.mod:
+            raise CourseException(f"modules is supposed to be of type mod_{meta.mod}, but is mod_{modname}")
+        if meta.course is not None and course != meta.course:
+            raise CourseException(f"modules is supposed to be in course {meta.course}, but is in {course}")
+
+    def verify_section(self, meta: SectionMeta):
+        if meta.course is None:
+            # there's nothing to verify the section against
+            return
+
+        sections, _ = self.course(meta.course)
+        if meta.section not in sections:
+            raise CourseException(f"section is supposed to be in course {meta.course}")
+
+
+def collect_metas(modules: list[Path], verify_with=None, manifests: set[Path]=None, *, jobs: Optional[int] = None) -> list[tuple[str, Path, ModuleMeta | SectionMeta]]:
+    return list(iter_metas(modules, verify_with, manifests, jobs=jobs))
+
+
+def iter_metas(modules: list[Path], verify_with=None, manifests: set[Path]=None, *, jobs: Optional[int] = None, ahead: Optional[int] = None) -> Iterator[tuple[str, Path, ModuleMeta | SectionMeta]]:
+    # metas are yielded as soon as they are read, so that later stages can start before all
+    # manifests are processed. If a `manifests` set is given, all files that are read as manifests
+    # are added to it.
+    # Manifests are read ahead on `jobs` threads (by default, one per CPU): as soon as a manifest
+    # is read, the files it includes are queued. Threads are used instead of processes so that the
+    # Typst documents queried for frontmatter can be reused for rendering. At most `ahead` files
+    # (by default, four per thread) are kept read ahead of the caller, and metas are still yielded
+    # in order.
+    from collections import deque
+    from concurrent.futures import Future, ThreadPoolExecutor
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if ahead is None:
+        ahead = 4 * jobs
+
     def read_input(input_path: Path):
         ext = input_path.suffix
         match ext:
-            case '.yaml' | '.yml':
-                return YAML(typ='safe').load(input_path)
-            case '.md':
-                return next(YAML(typ='safe').load_all(input_path))
+            case '.yaml' | '.yml' | '.md':
+                return sources.data(input_path)
             case '.typ':
                 return typst.frontmatter(input_path)
             case _:
                 raise CourseException(f"unknown input type: {input_path} (supported: .yaml/.yml, .md, .typ)")
 
+    def includes(data, root: Path) -> Iterator[Path]:
+        # the files included by a manifest, also through inline children
+        children = data.get('children') if isinstance(data, dict) else None
+        for child in children or []:
+            if isinstance(child, dict):
+                yield from includes(child, root)
+            else:
+                yield root/child
+
+    executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    # resolved path -> the file's parsed content, for files that were read ahead but not collected yet
+    loaded: dict[Path, Future] = {}
+    # files to read ahead, in the order they were found, and the resolved paths of collected files
+    queued = deque()
+    collected = set()
+    lock = threading.Lock()
+
+    def read(input_path: Path):
+        with tracer.module(str(input_path)), tracer.span('parse'):
+            data = read_input(input_path)
+        if executor is not None:
+            with lock:
+                queued.extend(includes(data, input_path.parent))
+            read_ahead()
+        return data
+
+    def read_ahead():
+        with lock:
+            while queued and len(loaded) < ahead:
+                input_path = queued.popleft()
+                key = input_path.resolve()
+                if key in loaded or key in collected:
+                    continue
+                try:
+                    loaded[key] = executor.submit(read, input_path)
+                except RuntimeError:
+                    # the executor was shut down because the caller stopped iterating
+                    return
+
+    def load(input_path: Path, key: Path):
+        with lock:
+            future = loaded.pop(key, None)
+            collected.add(key)
+        # files included more than once are read again; `sources` and `typst` keep their content
+        data = read(input_path) if future is None else future.result()
+        if executor is not None:
+            read_ahead()
+        return data
+
+    verifier = Verifier(verify_with) if verify_with is not None else None
+
     def prepare_module_meta(meta) -> ModuleMeta:
         meta = ModuleMeta(**meta)
-
-        if verify_with is not None:
-            moodle = verify_with
-            cm = moodle.get_course_module(meta.cmid).cm
-            if cm.modname != meta.mod:
-                raise CourseException(f"modules is supposed to be of type mod_{meta.mod}, but is mod_{cm.modname}")
-            if meta.course is not None and cm.course != meta.course:
-                raise CourseException(f"modules is supposed to be in course {meta.course}, but is in {cm.course}")
-
+        if verifier is not None:
+            verifier.verify_module(meta)
         return meta
 
     def prepare_section_meta(meta) -> SectionMeta:
         meta.pop('mod')
         meta = SectionMeta(**meta)
-
-        if verify_with is not None:
-            moodle = verify_with
-            sections = moodle.core.course.get_contents(meta.course, [ContentOption('excludemodules', True)])
-            if not any(section.id == meta.section for section in sections):
-                raise CourseException(f"section is supposed to be in course {meta.course}")
-
+        if verifier is not None:
+            verifier.verify_section(meta)
         return meta
 
-    module_metas = []
-    def collect(input_value, root=None, nesting_info=None):
+    def collect(input_value, root=None, nesting_info=None, including=()):
+        # `including` are the resolved paths of the manifests that (transitively) include this input
         if isinstance(input_value, dict):
             # the top level inputs are paths, so we shouldn't get here without nesting info
             assert nesting_info is not None
@@ -218,7 +327,15 @@ def collect_metas(modules: list[Path], verify_with=None) -> list[tuple[Path, Mod
             if root is not None:
                 # nested input: interpret relative to root
                 input_value = root/input_value
-            meta = read_input(input_value)
+            key = input_value.resolve()
+            if key in including:
+                cycle = [*including[including.index(key):], key]
+                raise CourseException(f"manifests include each other: {' -> '.join(map(str, cycle))}")
+            including = (*including, key)
+            # the parsed content is shared between all inclusions of a file; collecting modifies it
+            meta = copy.deepcopy(load(input_value, key))
+            if manifests is not None:
+                manifests.add(input_value)
             root = input_value.parent
             name = str(input_value)
 
@@ -232,7 +349,7 @@ def collect_metas(modules: list[Path], verify_with=None) -> list[tuple[Path, Mod
             else:
                 raise ValueError(f"{name}: unknown special module type '{meta['mod']}'")
 
-            module_metas.append((name, root, meta))
+            yield name, root, meta
         elif meta != {}:
             raise ValueError(f"unexpected extra content in {name}: {meta}")
         elif children is None:
@@ -240,9 +357,11 @@ def collect_metas(modules: list[Path], verify_with=None) -> list[tuple[Path, Mod
 
         if children is not None:
             for i, input_value in enumerate(children):
-                collect(input_value, root, (name, i))
-
-    for input_path in modules:
-        collect(input_path)
-
-    return module_metas
+                yield from collect(input_value, root, (name, i), including)
+
+    try:
+        for input_path in modules:
+            yield from collect(input_path)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,92 @@
+from collections import defaultdict
+from pathlib import Path
+import hashlib
+import json
+import os
+
+from .course import ModuleMeta, SectionMeta
+from .files import stamp, write_atomic
+
+
+class DependencyIndex:
+    """
+    A persistent cache of each module's dependencies. An entry is reused as long as the module's
+    definition is the same and the Typst sources that contributed to it (which can declare
+    additional attachments and dependencies) have the same modification time and size.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        try:
+            with open(path, 'rt') as f:
+                self.modules = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.modules = {}
+        # resolved dependency -> the names of the modules depending on it
+        self.dependents = defaultdict(set)
+        for name, entry in self.modules.items():
+            for dep in entry['resolved']:
+                self.dependents[dep].add(name)
+        self.dirty = False
+
+    def dependencies(self, name: str, root: Path, module: ModuleMeta | SectionMeta) -> list[Path]:
+        fingerprint = hashlib.sha256(f'{os.getcwd()}\0{root}\0{module!r}'.encode()).hexdigest()
+
+        entry = self.modules.get(name)
+        if entry is not None and entry['fingerprint'] == fingerprint and all(
+            # stamps that were read from the file are lists
+            stamp(Path(path)) == (tuple(s) if s is not None else None)
+            for path, s in entry['stamps'].items()
+        ):
+            return [Path(dep) for dep in entry['dependencies']]
+
+        dependencies = sorted(module.dependencies(root))
+        self._remove(name)
+        self.modules[name] = dict(
+            fingerprint=fingerprint,
+            stamps={
+                str(dep): stamp(dep)
+                for dep in dependencies
+                if dep.suffix == '.typ'
+            },
+            dependencies=[str(dep) for dep in dependencies],
+            resolved=sorted({str(dep.resolve()) for dep in dependencies}),
+        )
+        for dep in self.modules[name]['resolved']:
+            self.dependents[dep].add(name)
+        self.dirty = True
+        return dependencies
+
+    def _remove(self, name: str):
+        entry = self.modules.pop(name, None)
+        if entry is None:
+            return
+        for dep in entry['resolved']:
+            self.dependents[dep].discard(name)
+            if not self.dependents[dep]:
+                del self.dependents[dep]
+        self.dirty = True
+
+    def is_affected(self, name: str, root: Path, module: ModuleMeta | SectionMeta, changes: set[Path]) -> bool:
+        self.dependencies(name, root, module)
+        return any(name in self.dependents.get(str(change), ()) for change in changes)
+
+    def prune(self):
+        """
+        Removes the entries of modules whose manifest or one of whose dependencies doesn't exist
+        anymore. Other entries are kept, even if they were not looked up: the index is shared by
+        all commands run in the same directory, e.g. on different manifests.
+        """
+        for name, entry in list(self.modules.items()):
+            # names of modules in inline children are e.g. `<manifest>:children[0]`
+            manifest = name.split(':children[', 1)[0]
+            if not os.path.exists(manifest) or not all(os.path.exists(dep) for dep in entry['resolved']):
+                self._remove(name)
+
+    def save(self):
+        self.prune()
+        if not self.dirty:
+            return
+
+        write_atomic(self.path, lambda tmp: tmp.write_text(json.dumps(self.modules, indent=2, sort_keys=True)))
+        self.dirty = False
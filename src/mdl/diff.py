@@ -0,0 +1,198 @@
+from dataclasses import dataclass, field
+from typing import Optional
+import hashlib
+import re
+import threading
+
+from . import typst
+from .payload import ModulePayload, UploadFile
+
+
+# Moodle returns texts as stored (with `@@PLUGINFILE@@` references) instead of formatting them
+_RAW = dict(moodlewssettingraw=1, moodlewssettingfileurl=0)
+
+
+@dataclass(kw_only=True)
+class RemoteEditor:
+    text: str
+    format: int
+    # file path in the file area -> size
+    files: dict[str, int] = field(default_factory=dict)
+
+
+@dataclass(kw_only=True)
+class RemoteModule:
+    editors: dict[str, RemoteEditor] = field(default_factory=dict)
+    files: dict[str, dict[str, int]] = field(default_factory=dict)
+
+
+def _files(entries) -> dict[str, int]:
+    return {
+        f"{entry.get('filepath') or '/'}{entry['filename']}": entry.get('filesize')
+        for entry in entries or []
+        if entry.get('filename') not in (None, '.')
+    }
+
+
+def _editor(data: dict, text: str, files: str) -> RemoteEditor:
+    return RemoteEditor(text=data.get(text) or '', format=data.get(f'{text}format', 1), files=_files(data.get(files)))
+
+
+# how each module type's content is read in bulk: the function returning the modules of several
+# courses, the modules in its response, and where each part of the payload is found in a module
+_MODULES = {
+    'assign': (
+        'mod_assign_get_assignments',
+        lambda data: [a for course in data['courses'] for a in course['assignments']],
+        'cmid',
+        lambda a: RemoteModule(
+            editors=dict(
+                intro=_editor(a, 'intro', 'introfiles'),
+                activity=_editor(a, 'activity', 'activityattachments'),
+            ),
+            files=dict(attachments=_files(a.get('introattachments'))),
+        ),
+    ),
+    'folder': (
+        'mod_folder_get_folders_by_courses',
+        lambda data: data['folders'],
+        'coursemodule',
+        # the folder's files are taken from the course contents
+        lambda f: RemoteModule(editors=dict(intro=_editor(f, 'intro', 'introfiles'))),
+    ),
+    'label': (
+        'mod_label_get_labels_by_courses',
+        lambda data: data['labels'],
+        'coursemodule',
+        lambda l: RemoteModule(editors=dict(intro=_editor(l, 'intro', 'introfiles'))),
+    ),
+    'page': (
+        'mod_page_get_pages_by_courses',
+        lambda data: data['pages'],
+        'coursemodule',
+        lambda p: RemoteModule(editors=dict(
+            intro=_editor(p, 'intro', 'introfiles'),
+            page=RemoteEditor(text=p.get('content') or '', format=p.get('contentformat', 1), files=_files(p.get('contentfiles'))),
+        )),
+    ),
+    'resource': (
+        'mod_resource_get_resources_by_courses',
+        lambda data: data['resources'],
+        'coursemodule',
+        lambda r: RemoteModule(
+            editors=dict(intro=_editor(r, 'intro', 'introfiles')),
+            files=dict(files=_files(r.get('contentfiles'))),
+        ),
+    ),
+}
+
+
+class RemoteContents:
+    """
+    Reads the current content of modules and sections from Moodle, for comparing it with prepared
+    payloads. Content is read in bulk: one request per course and module type, plus the course
+    contents for sections and folder files. Reads bypass the `--cache`, which may be older than the
+    content it is compared with.
+    """
+
+    def __init__(self, moodle):
+        self.moodle = moodle
+        # (course ID, module type or '$section') -> {cmid or section ID: RemoteModule}
+        self.fetched = {}
+        self.lock = threading.Lock()
+
+    def course_of(self, payload: ModulePayload) -> Optional[int]:
+        if payload.course is not None:
+            return payload.course
+        if 'cmid' in payload.target:
+            return self.moodle.get_course_module(payload.target['cmid']).cm.course
+        return None
+
+    def _fetch(self, courseid: int, mod: str) -> dict[int, RemoteModule]:
+        if mod == '$section':
+            sections = self.moodle.post('core_course_get_contents', courseid=courseid, options=[], **_RAW, cached=False)
+            return {
+                section['id']: RemoteModule(editors=dict(summary=_editor(section, 'summary', None)))
+                for section in sections
+            }
+
+        function, modules, id, remote = _MODULES[mod]
+        result = {
+            module[id]: remote(module)
+            for module in modules(self.moodle.post(function, courseids=[courseid], **_RAW, cached=False))
+        }
+        if mod == 'folder':
+            for section in self.moodle.post('core_course_get_contents', courseid=courseid, options=[], **_RAW, cached=False):
+                for cm in section['modules']:
+                    if cm['id'] in result:
+                        result[cm['id']].files['files'] = _files(
+                            content for content in cm.get('contents') or [] if content.get('type') == 'file'
+                        )
+        return result
+
+    def get(self, payload: ModulePayload) -> Optional[RemoteModule]:
+        courseid = self.course_of(payload)
+        if courseid is None:
+            return None
+        if 'cmid' in payload.target:
+            mod, id = payload.function.removeprefix('update_').removesuffix('_content'), payload.target['cmid']
+        else:
+            mod, id = '$section', payload.target['section']
+
+        with self.lock:
+            if (courseid, mod) not in self.fetched:
+                self.fetched[courseid, mod] = self._fetch(courseid, mod)
+            return self.fetched[courseid, mod].get(id)
+
+
+def normalize_text(text: str, format: int) -> str:
+    """
+    Normalizes text so that insignificant differences, e.g. in whitespace or in how Moodle
+    serializes HTML, don't count as changes.
+    """
+    text = text.replace('\r\n', '\n').strip()
+    if format == 1:
+        text = typst.postprocess(text, minify=True)
+        # whitespace between tags, and void elements written as `<br />` or `<br>`
+        text = re.sub(r'>\s+<', '><', text)
+        text = re.sub(r'\s*/>', '>', text)
+    else:
+        text = re.sub(r'[ \t]+\n', '\n', text)
+    return text
+
+
+def text_digest(text: str, format: int) -> str:
+    return hashlib.sha256(normalize_text(text, format).encode()).hexdigest()
+
+
+def _local_files(files: list[UploadFile]) -> dict[str, int]:
+    return {f'/{dest}': f.stat().st_size for dest, f in files}
+
+
+def differences(payload: ModulePayload, remote: Optional[RemoteModule]) -> list[str]:
+    """
+    Returns the parts of the payload (e.g. `intro`, `intro files`) that differ from the remote
+    content, or `['module']` if the module was not found.
+    """
+    if remote is None:
+        return ['module']
+
+    result = []
+    for name, editor in payload.editors.items():
+        theirs = remote.editors.get(name)
+        if theirs is None:
+            result.append(name)
+            continue
+        if editor is None:
+            # the update replaces a missing editor by empty text, regardless of the format
+            if normalize_text(theirs.text, theirs.format) != '' or theirs.files:
+                result.append(name)
+            continue
+        if editor.format != theirs.format or text_digest(editor.text, editor.format) != text_digest(theirs.text, theirs.format):
+            result.append(name)
+        if _local_files(editor.files) != theirs.files:
+            result.append(f'{name} files')
+    for name, files in payload.files.items():
+        if _local_files(files) != remote.files.get(name):
+            result.append(name)
+    return result
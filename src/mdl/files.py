@@ -0,0 +1,31 @@
+from pathlib import Path
+from typing import Callable
+import os
+import threading
+
+
+def stamp(path: Path) -> tuple[int, int] | None:
+    """
+    Returns a file's modification time and size, which are compared to detect changes to the file;
+    or `None` if it doesn't exist.
+    """
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def write_atomic(path: Path, write: Callable[[Path], None]):
+    """
+    Replaces a file by calling `write` with a temporary file next to it, which is then renamed; an
+    interrupted run can't leave a partially written file behind. Temporary files are named per
+    process and thread, so concurrent writers don't interfere with each other.
+    """
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
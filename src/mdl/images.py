@@ -0,0 +1,93 @@
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+import hashlib
+
+from .files import write_atomic
+from .trace import tracer
+
+
+# image types that are recompressed; others (e.g. SVG or GIF animations) are uploaded as they are
+_FORMATS = {
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.png': 'PNG',
+    '.webp': 'WEBP',
+}
+
+
+@dataclass(kw_only=True, frozen=True)
+class ImageOptimizer:
+    """
+    Recompresses images before they are uploaded: images are scaled down to at most `max_size`
+    pixels in either dimension, metadata such as EXIF is removed, and optionally, images are
+    converted to WebP. Results are stored in a cache directory under a hash of the original content
+    and the settings, so each image is only processed once, even across runs.
+
+    This requires Pillow (the `images` extra).
+    """
+
+    cache: Path
+    max_size: int = 2048
+    quality: int = 85
+    webp: bool = False
+
+    def optimize(self, dest: PurePosixPath, path: Path, *, convert: bool = True) -> tuple[PurePosixPath, Path]:
+        """
+        Returns the file to upload instead of `path`. If `convert` is false, the image keeps its
+        format (and name); this is the case for files that students download by name, e.g. in
+        folders.
+        """
+        from .payload import file_hash
+
+        format = _FORMATS.get(path.suffix.lower())
+        if format is None:
+            return dest, path
+        if convert and self.webp:
+            format = 'WEBP'
+            dest = dest.with_suffix('.webp')
+
+        # the version at the end invalidates images cached by versions that kept some metadata
+        settings = f'{self.max_size}:{self.quality}:{format}:2'
+        key = hashlib.sha256(f'{file_hash(path)}\0{settings}'.encode()).hexdigest()
+        cached = self.cache/key[:2]/f'{key}{dest.suffix}'
+        if not cached.exists():
+            with tracer.span('image', file=str(path)) as span:
+                self._process(path, cached, format)
+                span['bytes'] = path.stat().st_size
+        return dest, cached
+
+    def _process(self, path: Path, cached: Path, format: str):
+        from PIL import Image, ImageOps, JpegImagePlugin
+
+        def save(tmp: Path, **options):
+            match format:
+                case 'JPEG':
+                    image.save(tmp, format, optimize=True, progressive=True, **options)
+                case 'PNG':
+                    image.save(tmp, format, optimize=True)
+                case 'WEBP':
+                    image.save(tmp, format, quality=self.quality, method=6)
+
+        def write(tmp: Path):
+            save(tmp, quality=self.quality)
+            if original is not None and tmp.stat().st_size >= path.stat().st_size:
+                # recompressing did not help. The original content can't be used because it contains
+                # the metadata; the original's quantization tables come close to its size instead
+                save(tmp, **original)
+
+        with Image.open(path) as image:
+            original = None
+            if format == 'JPEG' and image.format == 'JPEG':
+                original = dict(qtables=image.quantization, subsampling=JpegImagePlugin.get_sampling(image))
+            # apply the EXIF orientation before the metadata is dropped
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((self.max_size, self.max_size))
+            if format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            # metadata in `info` (e.g. XMP or JPEG comments) would be written again; only the color
+            # profile is kept
+            image.info = {key: value for key, value in image.info.items() if key == 'icc_profile'}
+
+            cached.parent.mkdir(parents=True, exist_ok=True)
+            # several processes may optimize the same image; each writes its own file first
+            write_atomic(cached, write)
@@ -0,0 +1,63 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+
+from .course import ModuleMeta, SectionMeta
+from .payload import file_hash
+
+
+class RunJournal:
+    """
+    Records each module as soon as an upload run completes it, so that an interrupted or failed
+    run can be resumed without rendering and uploading the completed modules again. Entries are
+    appended to a JSON Lines file, which a run that completes without failures removes.
+    """
+
+    def __init__(self, path: Path, site: str, *, resume: bool = False):
+        self.path = path
+        self.site = site
+        # module name -> the entry recorded when it was completed
+        self.completed = {}
+        if resume:
+            try:
+                with open(path, 'rt') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            # the last entry may be incomplete if the run was killed while writing it
+                            continue
+                        if entry.get('site') == site:
+                            self.completed[entry['name']] = entry
+            except FileNotFoundError:
+                pass
+        self.file = open(path, 'at' if resume else 'wt')
+
+    def is_complete(self, name: str, inputs: str | None) -> bool:
+        entry = self.completed.get(name)
+        return inputs is not None and entry is not None and entry['inputs'] == inputs
+
+    def record(self, name: str, key: str, inputs: str | None, digest: str):
+        entry = dict(site=self.site, name=name, key=key, inputs=inputs, digest=digest)
+        self.file.write(json.dumps(entry) + '\n')
+        # entries must survive the process being killed
+        self.file.flush()
+
+    def close(self, *, complete: bool):
+        self.file.close()
+        if complete:
+            os.remove(self.path)
+
+
+def inputs_digest(root: Path, module: ModuleMeta | SectionMeta, dependencies: list[Path], options) -> str | None:
+    """
+    Returns a digest of everything a module's payload is rendered from: its definition, the content
+    of the files it depends on and the rendering options; or `None` if a file can't be read.
+    """
+    try:
+        files = [(str(dep), file_hash(dep)) for dep in dependencies]
+    except OSError:
+        return None
+    data = dict(root=str(root.resolve()), module=repr(module), files=files, options=repr(options))
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
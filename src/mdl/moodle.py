@@ -1,5 +1,20 @@
-from moodle import Moodle as _Moodle, BaseMoodle
+from functools import cached_property
+from pathlib import Path
+from typing import Optional
+import json
+import re
+import secrets
+import time
+
+from moodle import Moodle as _Moodle, BaseMoodle, MoodleException
+from moodle.exception import EmptyResponseException, NetworkMoodleException
 from moodle.utils.decorator import lazy
+from moodle.utils.helper import to_dict
+from requests.exceptions import RequestException
+
+from .cache import ReadCache
+from .trace import tracer
+from .transport import Transport
 
 
 class ModContentService(BaseMoodle):
@@ -79,11 +94,238 @@ class ModContentService(BaseMoodle):
         return data
 
 
+class _CallRecorder:
+    # stands in for the client so that a service method returns its webservice call instead of
+    # sending it
+    def post(self, wsfunction: str, **kwargs):
+        return wsfunction, kwargs
+
+
+class BatchedModContentService:
+    """
+    Sends several Module Content Service updates in one request, using Moodle's
+    `tool_mobile_call_external_functions`. Moodle stops processing a batch at the first failing call;
+    the calls after it are sent again in another request.
+    """
+
+    FUNCTION = 'tool_mobile_call_external_functions'
+
+    def __init__(self, moodle: "Moodle"):
+        self.moodle = moodle
+        self.recorder = ModContentService(_CallRecorder())
+
+    def update(self, calls: list[tuple[str, dict]]) -> list:
+        """
+        Performs `(method, kwargs)` calls of `ModContentService` methods, e.g.
+        `('update_label_content', dict(cmid=2, intro=...))`. Returns the results in the same order; a
+        call that failed has a `MoodleException` as its result.
+        """
+        requests = [getattr(self.recorder, method)(**kwargs) for method, kwargs in calls]
+        results = []
+        while len(results) < len(requests):
+            batch = requests[len(results):]
+            data = self.moodle.post(
+                self.FUNCTION,
+                # the batch can be repeated if all of its calls can
+                idempotent=all(self.moodle.is_idempotent(wsfunction) for wsfunction, _ in batch),
+                requests=[
+                    dict(function=wsfunction, arguments=json.dumps(args))
+                    for wsfunction, args in batch
+                ],
+            )
+            if not data['responses']:
+                raise EmptyResponseException()
+            for response in data['responses']:
+                if response['error']:
+                    error = json.loads(response.get('exception') or '{}')
+                    results.append(MoodleException(
+                        errorcode=error.get('errorcode'),
+                        exception=error.get('exception'),
+                        message=error.get('message'),
+                        debuginfo=error.get('debuginfo'),
+                    ))
+                else:
+                    results.append(json.loads(response['data']) if response.get('data') else None)
+        return results
+
+
+class MultipartBody:
+    """
+    A `multipart/form-data` request body that reads files in fixed-size chunks while it is being
+    sent. At most one file is open at a time, and memory use does not depend on the file sizes.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, files: list[tuple[str, Path]], progress=None):
+        self.boundary = secrets.token_hex(16)
+        self.progress = progress
+        self.parts = []
+        for i, (name, f) in enumerate(files):
+            name = name.replace('"', '%22')
+            header = (
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="file_{i + 1}"; filename="{name}"\r\n'
+                f'Content-Type: application/octet-stream\r\n'
+                f'\r\n'
+            ).encode()
+            self.parts.append((header, f, f.stat().st_size))
+        self.trailer = f'--{self.boundary}--\r\n'.encode()
+        self.size = sum(size for _, _, size in self.parts)
+        self._chunks = None
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        # lets the HTTP layer send a Content-Length instead of a chunked body
+        return sum(len(header) + size + 2 for header, _, size in self.parts) + len(self.trailer)
+
+    def __iter__(self):
+        self._chunks = self._generate()
+        return self._chunks
+
+    def _generate(self):
+        sent = 0
+        for header, f, _ in self.parts:
+            yield header
+            with open(f, 'rb') as f:
+                while chunk := f.read(self.CHUNK_SIZE):
+                    yield chunk
+                    sent += len(chunk)
+                    if self.progress is not None:
+                        self.progress(sent, self.size)
+            yield b'\r\n'
+        yield self.trailer
+
+    def close(self):
+        # closes the file that is currently being read, if the upload was aborted
+        if self._chunks is not None:
+            self._chunks.close()
+
+
 class Moodle(_Moodle):
-    def __init__(self, url: str, token: str):
+    def __init__(self, url: str, token: str, transport: Transport=None, cache: ReadCache=None):
+        self.transport = transport if transport is not None else Transport()
+        self.cache = cache
+        # the key of this client's entries in the cache
+        self.cache_site = ReadCache.site(url, token)
+        # don't share moodlepy's class-level session between clients
+        self.session = self.transport.session
         super(Moodle, self).__init__(url, token)
+        # called as `upload_progress(label, sent, total, elapsed)` while uploading draft files
+        self.upload_progress = None
+
+    @staticmethod
+    def is_idempotent(wsfunction: str) -> bool:
+        # reading data, or replacing it with the same content, can be repeated safely
+        return re.search(r'_(get|search|update)_', wsfunction) is not None
+
+    def post(self, wsfunction: str, moodlewsrestformat="json", *, cached: bool = True, idempotent: Optional[bool] = None, **kwargs):
+        # with `cached=False`, the response is read from Moodle even if it is cached, and then
+        # replaces the cached one. `idempotent` overrides `is_idempotent`, e.g. for functions that
+        # call other functions
+        if idempotent is None:
+            idempotent = self.is_idempotent(wsfunction)
+        if self.cache is not None and moodlewsrestformat == "json" and cached:
+            data = self.cache.get(self.cache_site, wsfunction, kwargs)
+            if data is not None:
+                return data
+
+        params = {
+            "wstoken": self.token,
+            "wsfunction": wsfunction,
+            "moodlewsrestformat": moodlewsrestformat,
+        }
+        try:
+            with tracer.span('webservice', function=wsfunction):
+                res = self.transport.request(
+                    'POST', self.url,
+                    idempotent=idempotent,
+                    data=to_dict(kwargs),
+                    params=params,
+                )
+        except RequestException as e:
+            raise NetworkMoodleException(e)
+        if not res.ok or not res.text:
+            raise EmptyResponseException()
+        if moodlewsrestformat == "json":
+            data = self.process_response(json.loads(res.text))
+            if self.cache is not None:
+                self.cache.put(self.cache_site, wsfunction, kwargs, data)
+            return data
+        return res.text
+
+    @property
+    def upload_url(self) -> str:
+        return self.url.removesuffix('/webservice/rest/server.php') + '/webservice/upload.php'
+
+    def upload_draft(self, files: list[tuple[str, Path]], *, itemid: int=0, filepath: str='/') -> int:
+        """
+        Uploads files into a draft area, streaming the file contents. Returns the draft area's
+        itemid; if `itemid` is 0, a new draft area is created.
+        """
+        label = f"{filepath}{files[0][0]}" + (f" and {len(files) - 1} more" if len(files) > 1 else "")
+        start = time.monotonic()
+
+        def progress(sent, total):
+            if self.upload_progress is not None:
+                self.upload_progress(label, sent, total, time.monotonic() - start)
+
+        body = MultipartBody(files, progress)
+        try:
+            with tracer.span('draft upload', files=len(files), bytes=body.size):
+                res = self.transport.request(
+                    'POST', self.upload_url,
+                    # uploading into a new draft area again only leaves an unused draft area behind
+                    idempotent=itemid == 0,
+                    params=dict(token=self.token, filearea='draft', itemid=itemid, filepath=filepath),
+                    data=body,
+                    headers={'Content-Type': body.content_type},
+                )
+        except RequestException as e:
+            raise NetworkMoodleException(e)
+        finally:
+            body.close()
+        if not res.ok or not res.text:
+            raise EmptyResponseException()
+
+        data = json.loads(res.text)
+        if isinstance(data, dict):
+            raise MoodleException(
+                errorcode=data.get('errorcode'),
+                exception=data.get('exception'),
+                message=data.get('error'),
+                debuginfo=data.get('debuginfo'),
+            )
+        return data[0]['itemid']
+
+    def new_draft_itemid(self) -> Optional[int]:
+        """
+        Returns the itemid of a new, empty draft area, or `None` if Moodle does not allow this; in
+        that case, the first upload creates the draft area.
+        """
+        if 'core_files_get_unused_draft_itemid' not in self.functions:
+            return None
+        return self.post('core_files_get_unused_draft_itemid')['itemid']
+
+    @cached_property
+    def functions(self) -> set[str]:
+        # the webservice functions available to this token
+        info = self.post('core_webservice_get_site_info')
+        return {function['name'] for function in info.get('functions', [])}
 
     @property  # type: ignore
     @lazy
     def modcontentservice(self) -> ModContentService:
         return ModContentService(self)
+
+    @property
+    def batched_modcontentservice(self) -> Optional[BatchedModContentService]:
+        """
+        The batched Module Content Service, or `None` if Moodle does not allow batching calls.
+        """
+        if BatchedModContentService.FUNCTION not in self.functions:
+            return None
+        return BatchedModContentService(self)
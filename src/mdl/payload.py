@@ -0,0 +1,188 @@
+from dataclasses import dataclass, field
+from pathlib import Path, PurePosixPath
+from typing import Optional
+import hashlib
+import json
+import os
+
+from .course import ModuleMeta, SectionMeta
+from .images import ImageOptimizer
+from . import sources, typst
+from .trace import tracer
+
+
+# a file to upload: the destination path inside the file area, and the local source file
+UploadFile = tuple[PurePosixPath, Path]
+
+
+@dataclass(kw_only=True)
+class EditorPayload:
+    text: str
+    format: int
+    files: list[UploadFile] = field(default_factory=list)
+
+
+@dataclass(kw_only=True)
+class ModulePayload:
+    # the name of the ModContentService method that receives this payload
+    function: str
+    # the identifying argument, e.g. `{'cmid': 2}` or `{'section': 1}`
+    target: dict[str, int]
+    # the course the module/section belongs to, if known; not part of the uploaded content
+    course: Optional[int] = None
+    editors: dict[str, Optional[EditorPayload]] = field(default_factory=dict)
+    files: dict[str, list[UploadFile]] = field(default_factory=dict)
+
+    @property
+    def key(self) -> str:
+        return ','.join(f'{k}:{v}' for k, v in self.target.items())
+
+    def digest(self) -> str:
+        def files_summary(files):
+            return [(str(dest), file_hash(source)) for dest, source in files]
+
+        data = dict(
+            function=self.function,
+            target=self.target,
+            editors={
+                name: None if editor is None else dict(
+                    text=editor.text,
+                    format=editor.format,
+                    files=files_summary(editor.files),
+                )
+                for name, editor in self.editors.items()
+            },
+            files={
+                name: files_summary(files)
+                for name, files in self.files.items()
+            },
+        )
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+_file_hashes = {}
+
+def file_hash(path: Path) -> str:
+    # the cache is keyed by the file's identity and modification state so that it survives edits
+    stat = path.stat()
+    key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+    if key not in _file_hashes:
+        with open(path, 'rb') as f, tracer.span('hash', file=str(path), bytes=stat.st_size):
+            _file_hashes[key] = hashlib.file_digest(f, 'sha256').hexdigest()
+    return _file_hashes[key]
+
+
+def _upload_file(root: Path, f: Path | tuple[Path, Path]) -> UploadFile:
+    if isinstance(f, tuple):
+        # a name, file pair
+        name, f = f
+        return PurePosixPath(name.as_posix()), root/f
+    else:
+        # assume the file goes into the root of the file area
+        return PurePosixPath(f.name), root/f
+
+
+def prepare_editor(root: Path, editor, *, minify: bool = False, images: Optional[ImageOptimizer] = None) -> Optional[EditorPayload]:
+    if editor == None:
+        return None
+
+    source = root/editor.source
+    attachments = list(editor.attachments)
+    suffix = editor.source.suffix
+
+    if suffix == '.typ':
+        # compile Typst document to HTML
+        text = typst.body(source)
+
+        # extract attachments from Typst metadata
+        attachments += [Path(att) for att in typst.attachments(source)]
+
+    else:
+        # read text file; for Markdown, without the prelude
+        text = sources.body(source)
+
+    match suffix:
+        case '.txt':
+            format = 2
+        case '.md':
+            format = 4
+        case '.html' | '.htm' | '.typ' | _:
+            format = 1
+
+    files = [_upload_file(root, f) for f in attachments]
+    uploads = files if images is None else [images.optimize(dest, f) for dest, f in files]
+    if format == 1:
+        # attachments can be referenced by their name in the draft area, or by their path relative
+        # to the source file
+        assets = {}
+        for (dest, f), (upload_dest, _) in zip(files, uploads):
+            url = typst.plugin_file_url(str(upload_dest))
+            assets[str(dest)] = url
+            assets[Path(os.path.relpath(f, source.parent)).as_posix()] = url
+            if upload_dest != dest:
+                assets[f'@@PLUGINFILE@@/{dest}'] = url
+        with tracer.span('html'):
+            text = typst.postprocess(text, assets=assets, minify=minify)
+    else:
+        for (dest, _), (upload_dest, _) in zip(files, uploads):
+            if upload_dest != dest:
+                # the optimized image was converted to a different format
+                text = text.replace(typst.plugin_file_url(str(dest)), typst.plugin_file_url(str(upload_dest)))
+
+    return EditorPayload(
+        text=text,
+        format=format,
+        files=uploads,
+    )
+
+
+def prepare_module(
+    root: Path,
+    module: ModuleMeta | SectionMeta,
+    *,
+    minify: bool = False,
+    images: Optional[ImageOptimizer] = None,
+) -> ModulePayload:
+    with tracer.span('render'):
+        return _prepare_module(root, module, minify, images)
+
+
+def _prepare_module(root: Path, module: ModuleMeta | SectionMeta, minify: bool, images: Optional[ImageOptimizer]) -> ModulePayload:
+    def prepare_files(files):
+        files = [_upload_file(root, f) for f in files]
+        if images is not None:
+            # these files are downloaded by their names, so their format is kept
+            files = [images.optimize(dest, f, convert=False) for dest, f in files]
+        return files
+
+    if isinstance(module, ModuleMeta):
+        payload = ModulePayload(
+            function=f'update_{module.mod}_content',
+            target=dict(cmid=module.cmid),
+            course=module.course,
+        )
+        payload.editors['intro'] = prepare_editor(root, module.intro, minify=minify, images=images)
+
+        match module.mod:
+            case 'assign':
+                payload.editors['activity'] = prepare_editor(root, module.activity, minify=minify, images=images)
+                payload.files['attachments'] = prepare_files(module.attachments)
+            case 'folder':
+                payload.files['files'] = prepare_files(module.files)
+            case 'label':
+                pass
+            case 'page':
+                payload.editors['page'] = prepare_editor(root, module.page, minify=minify, images=images)
+            case 'resource':
+                payload.files['files'] = prepare_files([module.file])
+    elif isinstance(module, SectionMeta):
+        payload = ModulePayload(
+            function='update_section_content',
+            target=dict(section=module.section),
+            course=module.course,
+        )
+        payload.editors['summary'] = prepare_editor(root, module.summary, minify=minify, images=images)
+    else:
+        raise ValueError(f"{module} was not a valid module/section configuration")
+
+    return payload
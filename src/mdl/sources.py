@@ -0,0 +1,91 @@
+from functools import cached_property
+from pathlib import Path
+import re
+import threading
+
+from .files import stamp
+from .trace import tracer
+
+
+# the separator ending a Markdown prelude; like a YAML document start, it may introduce a block scalar
+_SEPARATOR = re.compile(r'^---( [|>][+-]?\d*)?\n', re.MULTILINE)
+
+_yaml = threading.local()
+
+def _load_yaml(text: str, *, first: bool = False):
+    # creating a YAML instance is comparatively expensive, but instances can't be shared between
+    # threads; each thread keeps its own
+    loader = getattr(_yaml, 'loader', None)
+    if loader is None:
+        from ruamel.yaml import YAML
+        loader = _yaml.loader = YAML(typ='safe')
+    if first:
+        return next(loader.load_all(text))
+    return loader.load(text)
+
+
+class Source:
+    """
+    A YAML or Markdown source file that is read at most once: the module data (the whole file, or a
+    Markdown file's prelude) and the Markdown content after the prelude are both taken from the same
+    read.
+    """
+
+    def __init__(self, filename: Path):
+        self.filename = filename
+        self.stamp = stamp(filename)
+        with tracer.span('read', file=str(filename)) as span:
+            with open(filename, 'rt', encoding='utf-8') as f:
+                self.text = f.read()
+            span['bytes'] = len(self.text)
+
+    @cached_property
+    def _prelude(self) -> tuple[int, int]:
+        # the end of the prelude's YAML and the start of the content after it
+        if self.filename.suffix != '.md' or not self.text.startswith('---'):
+            return 0, 0
+        matches = _SEPARATOR.finditer(self.text)
+        next(matches)  # the initial document separator
+        match = next(matches, None)
+        # no second match: assume that this was not a prelude
+        return (match.start(), match.end()) if match is not None else (0, 0)
+
+    @cached_property
+    def data(self):
+        if self.filename.suffix != '.md':
+            return _load_yaml(self.text)
+        end, _ = self._prelude
+        if end:
+            # only the prelude is parsed, not the content after it
+            return _load_yaml(self.text[:end])
+        return _load_yaml(self.text, first=True)
+
+    @property
+    def body(self) -> str:
+        return self.text[self._prelude[1]:]
+
+    def is_current(self) -> bool:
+        return stamp(self.filename) == self.stamp
+
+
+_sources = {}
+_sources_lock = threading.Lock()
+
+def source(filename: Path) -> Source:
+    key = filename.resolve()
+    with _sources_lock:
+        src = _sources.get(key)
+    if src is None or not src.is_current():
+        # files are read outside the lock, so that different files can be read at the same time
+        src = Source(key)
+        with _sources_lock:
+            _sources[key] = src
+    return src
+
+
+def data(filename: Path):
+    return source(filename).data
+
+
+def body(filename: Path) -> str:
+    return source(filename).body
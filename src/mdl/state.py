@@ -0,0 +1,44 @@
+from pathlib import Path
+import copy
+import json
+
+from .files import write_atomic
+
+
+class UploadState:
+    """
+    Remembers the digest of the last successfully uploaded payload per module/section, so that
+    unchanged content does not need to be uploaded again. Digests are stored per Moodle site, since
+    the same manifests may be uploaded to several installations.
+    """
+
+    def __init__(self, path: Path, site: str):
+        self.path = path
+        self.site = site
+        try:
+            with open(path, 'rt') as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {}
+
+    @property
+    def entries(self) -> dict[str, str]:
+        return self.data.setdefault(self.site, {})
+
+    def for_site(self, site: str) -> "UploadState":
+        """
+        Returns the state of another site, which is stored in the same file; saving either state
+        saves both.
+        """
+        state = copy.copy(self)
+        state.site = site
+        return state
+
+    def is_current(self, key: str, digest: str) -> bool:
+        return self.entries.get(key) == digest
+
+    def record(self, key: str, digest: str):
+        self.entries[key] = digest
+
+    def save(self):
+        write_atomic(self.path, lambda tmp: tmp.write_text(json.dumps(self.data, indent=2, sort_keys=True)))
@@ -0,0 +1,81 @@
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Optional
+import copy
+import os
+
+from . import sources
+from .course import CourseException, ModuleMeta, SectionMeta
+from .payload import ModulePayload
+
+
+@dataclass(kw_only=True)
+class Target:
+    """
+    A course that receives the content described by the manifests, e.g. a parallel course or a
+    copy on another Moodle site. The IDs of courses, sections and modules in the manifests are
+    mapped to their counterparts in the target; without a mapping for a kind of ID, IDs are used
+    as they are.
+    """
+
+    name: str
+    base_url: Optional[str] = None
+    token: Optional[str] = None
+    # the name of an environment variable containing the token, instead of `token`
+    token_env: Optional[str] = None
+    courses: Optional[dict[int, int]] = None
+    sections: Optional[dict[int, int]] = None
+    modules: Optional[dict[int, int]] = None
+
+    def __post_init__(self):
+        if self.token is None and self.token_env is not None:
+            self.token = os.getenv(self.token_env)
+        # IDs may have been written as strings, e.g. as keys in JSON-style mappings
+        for name in ('courses', 'sections', 'modules'):
+            mapping = getattr(self, name)
+            if mapping is not None:
+                setattr(self, name, {int(k): int(v) for k, v in mapping.items()})
+
+    def _map(self, mapping: Optional[dict[int, int]], kind: str, id: Optional[int]) -> Optional[int]:
+        if mapping is None or id is None:
+            return id
+        if id not in mapping:
+            raise CourseException(f"{kind} {id} has no counterpart in target {self.name}")
+        return mapping[id]
+
+    def map_meta(self, meta: ModuleMeta | SectionMeta) -> ModuleMeta | SectionMeta:
+        # only the identifying fields are replaced; the content is shared with the original
+        meta = copy.copy(meta)
+        meta.course = self._map(self.courses, "course", meta.course)
+        if isinstance(meta, ModuleMeta):
+            meta.cmid = self._map(self.modules, "module", meta.cmid)
+        else:
+            meta.section = self._map(self.sections, "section", meta.section)
+        return meta
+
+    def map_payload(self, payload: ModulePayload) -> ModulePayload:
+        if 'cmid' in payload.target:
+            target = dict(cmid=self._map(self.modules, "module", payload.target['cmid']))
+        else:
+            target = dict(section=self._map(self.sections, "section", payload.target['section']))
+        return replace(payload, target=target, course=self._map(self.courses, "course", payload.course))
+
+
+def read_targets(path: Path) -> list[Target]:
+    """
+    Reads a list of targets from a YAML file, e.g.:
+
+        - name: class-b
+          courses: {2: 12}
+          modules: {1001: 2001, 1002: 2002}
+        - name: second-site
+          base_url: https://moodle.example.org
+          token_env: SECOND_SITE_TOKEN
+    """
+    data = sources.data(path)
+    if not isinstance(data, list):
+        raise CourseException(f"{path}: expected a list of targets")
+    try:
+        return [Target(**entry) for entry in copy.deepcopy(data)]
+    except TypeError as ex:
+        raise CourseException(f"{path}: invalid target: {ex}")
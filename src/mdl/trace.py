@@ -0,0 +1,116 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+import json
+import os
+import threading
+import time
+
+
+# the module currently being processed, so that nested spans can be attributed to it
+_module: ContextVar[str | None] = ContextVar('module', default=None)
+
+
+class Tracer:
+    """
+    Records how long the phases of a run take, per module. Spans may be nested; e.g. a `render`
+    span contains the `typst.compile` spans of the module's Typst sources.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def module(self, name: str):
+        token = _module.set(name)
+        try:
+            yield
+        finally:
+            _module.reset(token)
+
+    @contextmanager
+    def span(self, phase: str, **args):
+        """
+        Records the duration of the enclosed code. A `bytes` argument is summed up in the summary
+        in addition to durations.
+        """
+        if not self.enabled:
+            yield args
+            return
+
+        start = time.time()
+        try:
+            # the caller may add arguments, e.g. the number of bytes, while the span is open
+            yield args
+        finally:
+            event = dict(
+                phase=phase,
+                module=_module.get(),
+                start=start,
+                duration=time.time() - start,
+                pid=os.getpid(),
+                tid=threading.get_ident(),
+                args=args,
+            )
+            with self.lock:
+                self.events.append(event)
+
+    def summary(self, limit: int = 10) -> str:
+        phases = defaultdict(lambda: [0, 0.0, 0])
+        modules = defaultdict(float)
+        for event in self.events:
+            stats = phases[event['phase']]
+            stats[0] += 1
+            stats[1] += event['duration']
+            stats[2] += event['args'].get('bytes', 0)
+            if event['module'] is not None and event['phase'] in ('parse', 'render', 'upload'):
+                modules[event['module']] += event['duration']
+
+        lines = [f"{'phase':<20} {'count':>7} {'total s':>9} {'mean ms':>9} {'MiB':>9}"]
+        for phase, (count, total, size) in sorted(phases.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{phase:<20} {count:>7} {total:>9.3f} {total / count * 1000:>9.1f} {size / 2**20:>9.2f}")
+
+        if modules:
+            lines.append("")
+            lines.append(f"{'slowest modules':<60} {'total s':>9}")
+            for name, total in sorted(modules.items(), key=lambda item: -item[1])[:limit]:
+                lines.append(f"{name[-60:]:<60} {total:>9.3f}")
+
+        return '\n'.join(lines)
+
+    def write_chrome_trace(self, path: Path):
+        # the Trace Event Format understood by chrome://tracing and Perfetto
+        events = [
+            dict(
+                name=event['phase'] if event['module'] is None else f"{event['phase']}: {event['module']}",
+                cat=event['phase'],
+                ph='X',
+                ts=event['start'] * 1e6,
+                dur=event['duration'] * 1e6,
+                pid=event['pid'],
+                tid=event['tid'],
+                args=dict(event['args'], module=event['module']),
+            )
+            for event in self.events
+        ]
+        with open(path, 'wt') as f:
+            json.dump(dict(traceEvents=events), f, default=str)
+
+
+tracer = Tracer()
+
+
+def call_traced(enabled: bool, module: str, fn, *args):
+    """
+    Calls a function in a worker process, and returns its result together with the events that were
+    recorded in the process, so that they can be added to the main process' tracer.
+    """
+    tracer.enabled = enabled
+    tracer.events = []
+    with tracer.module(module):
+        result = fn(*args)
+    events, tracer.events = tracer.events, []
+    return result, events
@@ -0,0 +1,81 @@
+from dataclasses import dataclass, field
+import random
+import time
+
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, RequestException, Timeout
+from urllib3.exceptions import NewConnectionError
+
+from .trace import tracer
+
+
+@dataclass(kw_only=True)
+class Transport:
+    """
+    The HTTP layer used for all requests to Moodle. Connections are pooled and kept alive, every
+    request has a timeout, and failed requests are retried with exponential backoff and jitter if
+    it's safe to do so.
+    """
+
+    # seconds to wait for connecting and for each read from the server
+    timeout: float = 60
+    # how often a failed request is repeated
+    retries: int = 3
+    # the delay before the first retry in seconds; doubles with every further attempt
+    backoff: float = 0.5
+    max_backoff: float = 30
+    # how many connections to keep open, e.g. for concurrent uploads
+    pool_size: int = 32
+
+    session: Session = field(init=False, repr=False)
+
+    # responses that indicate an overloaded or temporarily unavailable server
+    TRANSIENT_STATUS = frozenset({429, 502, 503, 504})
+
+    def __post_init__(self):
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method: str, url: str, *, idempotent: bool, **kwargs) -> Response:
+        """
+        Sends a request. Requests that failed before reaching the server are always retried, others
+        only if they are `idempotent`, i.e. repeating them has the same effect as sending them once.
+        """
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                with tracer.span('http', attempt=attempt + 1) as span:
+                    res = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                    span['status'] = res.status_code
+                    span['bytes'] = len(res.content)
+            except (ConnectionError, Timeout) as ex:
+                if last or not (idempotent or _not_sent(ex)):
+                    raise
+                delay = None
+            else:
+                if last or not idempotent or res.status_code not in self.TRANSIENT_STATUS:
+                    return res
+                delay = _retry_after(res)
+
+            if delay is None:
+                delay = self.backoff * 2**attempt
+                # spread out the retries of concurrent requests
+                delay = random.uniform(delay / 2, delay)
+            time.sleep(min(delay, self.max_backoff))
+
+
+def _not_sent(ex: RequestException) -> bool:
+    if isinstance(ex, ConnectTimeout):
+        return True
+    reason = getattr(ex.args[0], 'reason', None) if ex.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _retry_after(res: Response) -> float | None:
+    try:
+        return float(res.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return None
@@ -1,25 +1,169 @@
+from functools import cached_property
 from pathlib import Path
+from urllib.parse import quote, unquote
 import json
 import os
+import re
+import threading
 
-from bs4 import BeautifulSoup
-import typst
+from .files import stamp
+from .trace import tracer
+
+
+class Document:
+    """
+    A Typst document that is compiled at most once: all metadata is extracted through a single
+    query, and the HTML body is compiled by the same compiler instance, which reuses the evaluation
+    of the query.
+    """
+
+    def __init__(self, filename: Path, root: str | None):
+        # typst and BeautifulSoup are only imported once a document is actually needed
+        import typst
+
+        self.filename = filename
+        self.root = root
+        self.compiler = typst.Compiler(filename, root=root)
+        self.stamps = {filename: stamp(filename)}
+        # the compiler must not be used by several threads at the same time
+        self.lock = threading.Lock()
+
+    @cached_property
+    def metadata(self) -> dict[str, list]:
+        with self.lock, tracer.span('typst.query', file=str(self.filename)):
+            elements = json.loads(self.compiler.query('metadata'))
+
+        metadata = {}
+        for element in elements:
+            if 'label' in element:
+                metadata.setdefault(element['label'], []).append(element['value'])
+
+        # also consider declared dependencies when checking whether the document is up to date
+        for dep in metadata.get('<dependencies>', []):
+            path = self.filename.parent/dep
+            self.stamps[path] = stamp(path)
+
+        return metadata
+
+    @property
+    def frontmatter(self):
+        values = self.metadata.get('<frontmatter>', [])
+        if len(values) != 1:
+            raise ValueError(f"{self.filename}: expected exactly one <frontmatter> metadata element, found {len(values)}")
+        return values[0]
+
+    @property
+    def attachments(self) -> list:
+        return self.metadata.get('<attachments>', [])
+
+    @property
+    def dependencies(self) -> list:
+        return self.metadata.get('<dependencies>', [])
+
+    @cached_property
+    def body(self) -> str:
+        with self.lock, tracer.span('typst.compile', file=str(self.filename)) as span:
+            html = self.compiler.compile(format='html')
+            span['bytes'] = len(html)
+        with tracer.span('html', file=str(self.filename)):
+            return extract_body(html.decode('utf-8'))
+
+    def is_current(self) -> bool:
+        return all(stamp(path) == s for path, s in self.stamps.items())
+
+
+_BODY_START = re.compile(r'<body\b[^>]*>', re.IGNORECASE)
+_BODY_END = re.compile(r'</body\s*>', re.IGNORECASE)
+
+def extract_body(html: str) -> str:
+    """
+    Returns the contents of an HTML document's `<body>` element. Typst's output is well-formed, so
+    the body is simply cut out of the document instead of parsing it; only if that fails, the
+    document is parsed.
+    """
+    start = _BODY_START.search(html)
+    ends = list(_BODY_END.finditer(html, start.end())) if start is not None else []
+    if not ends:
+        from bs4 import BeautifulSoup
+
+        return BeautifulSoup(html, 'html.parser').body.decode_contents()
+    return html[start.end():ends[-1].start()]
+
+
+# the parts of an HTML fragment that post-processing looks at: elements whose contents must be kept
+# verbatim, comments, tags (for their attributes) and whitespace
+_HTML_TOKENS = re.compile(
+    r'(?P<verbatim><(?P<element>pre|textarea|script|style)\b.*?</(?P=element)\s*>)'
+    r'|(?P<comment><!--.*?-->)'
+    r'|(?P<tag><[a-zA-Z][^>]*>)'
+    r'|(?P<space>\s{2,}|[\t\r\n]\s*)',
+    re.IGNORECASE | re.DOTALL,
+)
+_URL_ATTRIBUTE = re.compile(r'''(\s(?:src|href)\s*=\s*)(?:"([^"]*)"|'([^']*)')''', re.IGNORECASE)
+
+def postprocess(html: str, *, assets: dict[str, str] | None = None, minify: bool = False) -> str:
+    """
+    Post-processes an HTML fragment in a single pass:
+
+    - `src` and `href` attributes referring to one of the `assets` are replaced by the mapped URL,
+      e.g. `image.png` by `@@PLUGINFILE@@/image.png`
+    - with `minify`, comments are removed and whitespace is collapsed, except inside `<pre>`,
+      `<textarea>`, `<script>` and `<style>` elements
+    """
+    if not assets and not minify:
+        return html
+
+    def rewrite_url(match):
+        prefix, value = match.group(1), match.group(2) if match.group(2) is not None else match.group(3)
+        url = assets.get(unquote(value).removeprefix('./'))
+        if url is None:
+            return match.group(0)
+        return f'{prefix}"{url}"'
+
+    def replace(match):
+        if match.group('tag') is not None:
+            if assets:
+                return _URL_ATTRIBUTE.sub(rewrite_url, match.group('tag'))
+            return match.group('tag')
+        if match.group('verbatim') is not None or not minify:
+            return match.group(0)
+        if match.group('comment') is not None:
+            return ''
+        # whitespace is significant between inline elements, so it's only shortened
+        return '\n' if '\n' in match.group('space') else ' '
+
+    return _HTML_TOKENS.sub(replace, html)
+
+
+def plugin_file_url(dest: str) -> str:
+    # files in an editor's draft area are referenced through this placeholder
+    return f'@@PLUGINFILE@@/{quote(dest)}'
+
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+def document(filename: Path) -> Document:
+    root = os.getenv('TYPST_ROOT')
+    key = (filename.resolve(), root)
+    with _documents_lock:
+        doc = _documents.get(key)
+        if doc is None or not doc.is_current():
+            doc = _documents[key] = Document(key[0], root)
+    return doc
 
 
 def frontmatter(filename: Path):
-    return json.loads(typst.query(filename, '<frontmatter>', root=os.getenv('TYPST_ROOT'), field="value", one=True))
+    return document(filename).frontmatter
 
 
 def attachments(filename: Path):
-    return json.loads(typst.query(filename, '<attachments>', root=os.getenv('TYPST_ROOT'), field="value"))
+    return document(filename).attachments
 
 
 def dependencies(filename: Path):
-    return json.loads(typst.query(filename, '<dependencies>', root=os.getenv('TYPST_ROOT'), field="value"))
+    return document(filename).dependencies
 
 
 def body(filename: Path):
-    html = typst.compile(filename, root=os.getenv('TYPST_ROOT'), format='html')
-    body = BeautifulSoup(html, 'html.parser').body.decode_contents()
-
-    return body
+    return document(filename).body
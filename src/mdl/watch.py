@@ -0,0 +1,131 @@
+from pathlib import Path
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from .files import stamp
+
+
+class PollingWatcher:
+    """
+    Detects changes to a set of files by periodically comparing their modification times and sizes.
+    """
+
+    def __init__(self, *, debounce: float = 0.2, interval: float = 0.25):
+        self.debounce = debounce
+        self.interval = interval
+        self.stamps = {}
+
+    def watch(self, paths: set[Path]):
+        # paths that are already watched keep their stamps, so that changes made since they were
+        # taken (e.g. while uploading) are still detected
+        self.stamps = {path: self.stamps[path] if path in self.stamps else stamp(path) for path in paths}
+
+    def _poll(self) -> set[Path]:
+        changed = set()
+        for path, old_stamp in self.stamps.items():
+            new_stamp = stamp(path)
+            if new_stamp != old_stamp:
+                self.stamps[path] = new_stamp
+                changed.add(path)
+        return changed
+
+    def wait(self) -> set[Path]:
+        changed = set()
+        while not changed:
+            time.sleep(self.interval)
+            changed = self._poll()
+
+        # wait until the burst of changes (e.g. an editor saving several files) is over
+        while True:
+            time.sleep(self.debounce)
+            more = self._poll()
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Detects changes to a set of files using Linux' inotify API on the containing directories. This
+    also catches editors that save by replacing a file instead of writing to it.
+    """
+
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, *, debounce: float = 0.2):
+        self.debounce = debounce
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        self.paths = set()
+
+    def watch(self, paths: set[Path]):
+        self.paths = set(paths)
+        for directory in {path.parent for path in paths} - set(self.dirs.values()):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd >= 0:
+                self.dirs[wd] = directory
+        # stale directory watches are harmless: events for unwatched files are ignored
+
+    def _read(self, timeout: float | None) -> set[Path]:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        buf = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(buf):
+            wd, _mask, _cookie, length = self.EVENT.unpack_from(buf, offset)
+            offset += self.EVENT.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            path = self.dirs.get(wd)
+            if path is not None and name:
+                path = path/os.fsdecode(name)
+                if path in self.paths:
+                    changed.add(path)
+        return changed
+
+    def wait(self) -> set[Path]:
+        changed = set()
+        while not changed:
+            changed = self._read(None)
+
+        # wait until the burst of changes (e.g. an editor saving several files) is over
+        while True:
+            more = self._read(self.debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher(*, debounce: float = 0.2, polling: bool = False):
+    if not polling:
+        try:
+            return InotifyWatcher(debounce=debounce)
+        except (AttributeError, OSError, TypeError):
+            # no inotify on this platform
+            pass
+    return PollingWatcher(debounce=debounce)